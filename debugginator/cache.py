@@ -0,0 +1,134 @@
+#-*- coding: utf-8 -*-
+'''
+On-disk columnar cache for parsed raw files so repeat runs don't parse the same extracts again
+'''
+import os
+import json
+import hashlib
+import pandas as pd
+
+DEFAULT_CACHE_DIR = '/root/thedebugginator/data/cache'
+
+class ExtractCache():
+    '''
+    Stores extracted dataframes as parquet files keyed by the source path, mtime, size and the read options
+    The schema of the cached dataframe is stored alongside in a json file and checked on every load
+
+    cache_dir : directory to keep the cached files in
+    max_bytes : size cap of the cache. least recently used entries are evicted once it is exceeded. defaults to 2GB
+
+    Parquet is written through pyarrow, which is installed with debugginator
+    '''
+    def __init__(self,cache_dir=DEFAULT_CACHE_DIR,max_bytes=2*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir,exist_ok=True)
+
+    def key(self,fstring,depends=(),**options):
+        '''
+        Key for a source file and the options it was read with. Changes whenever the file is modified
+        depends : other files the cached result is derived from, e.g. the default columns list. changes to them change the key too
+        '''
+        parts = []
+        for path in [fstring,*depends]:
+            stat = os.stat(path)
+            parts += [os.path.abspath(path),str(stat.st_mtime_ns),str(stat.st_size)]
+        parts.append(repr(sorted(options.items())))
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def _paths(self,key):
+        base = os.path.join(self.cache_dir,key)
+        return f'{base}.parquet', f'{base}.json'
+
+    def load(self,key):
+        '''Returns the cached dataframe for the key or None if there is no valid entry'''
+        data_path, schema_path = self._paths(key)
+        # another thread or process can evict the entry at any point, a vanished entry is just a miss
+        try:
+            with open(schema_path,'r') as f:
+                schema = json.load(f)
+            df = pd.read_parquet(data_path)
+        except FileNotFoundError:
+            return None
+        if list(df.columns) != schema['columns'] or [str(d) for d in df.dtypes] != schema['dtypes']:
+            self.remove(key)
+            return None
+
+        # touch the entry so eviction is least recently used
+        try:
+            os.utime(data_path)
+        except FileNotFoundError:
+            pass
+        return df
+
+    def save(self,key,df,source=None):
+        '''Writes the dataframe and its schema to the cache then evicts old entries if over the size cap'''
+        data_path, schema_path = self._paths(key)
+        try:
+            df.to_parquet(data_path)
+        except (TypeError,ValueError) as e:
+            # mixed type object columns can't be stored as parquet. skip caching rather than failing the read
+            print(f'Could not cache {source}: {e}')
+            self.remove(key)
+            return None
+        schema = {'source':source,
+                'columns':[str(c) for c in df.columns],
+                'dtypes':[str(d) for d in df.dtypes],
+                'rows':len(df)
+                }
+        with open(schema_path,'w') as f:
+            json.dump(schema,f,indent=4)
+
+        self.evict()
+        return None
+
+    def remove(self,key):
+        for path in self._paths(key):
+            # several threads or processes can evict the same entry at once
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return None
+
+    def _stat(self,path):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def size(self):
+        stats = [self._stat(os.path.join(self.cache_dir,f)) for f in os.listdir(self.cache_dir)]
+        return sum(s.st_size for s in stats if s is not None)
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits under max_bytes
+        Entries removed by a concurrent evict in the meantime are skipped
+        '''
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.parquet'):
+                continue
+            key = f[:-len('.parquet')]
+            stats = [self._stat(p) for p in self._paths(key)]
+            if stats[0] is None:
+                continue
+            entries.append((stats[0].st_mtime,key,sum(s.st_size for s in stats if s is not None)))
+
+        total = sum(e[2] for e in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+        return None
+
+    def clear(self):
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.parquet') or f.endswith('.json'):
+                try:
+                    os.remove(os.path.join(self.cache_dir,f))
+                except FileNotFoundError:
+                    pass
+        return None
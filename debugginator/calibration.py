@@ -0,0 +1,221 @@
+#-*- coding: utf-8 -*-
+'''
+Streaming calibration of anomaly thresholds from reconstruction losses
+'''
+import json
+import numpy as np
+from debugginator.instrument import instrumented
+
+class Moments():
+    '''Running count, mean and sum of squared deviations (Welford). Mergeable with Chan's parallel update'''
+    def __init__(self,count=0,mean=0.0,m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self,x):
+        x = np.asarray(x,dtype='float64').ravel()
+        if len(x) == 0:
+            return None
+        self.merge(Moments(len(x),float(x.mean()),float(((x - x.mean())**2).sum())))
+        return None
+
+    def merge(self,other):
+        total = self.count + other.count
+        if total == 0:
+            return None
+        delta = other.mean - self.mean
+        self.mean += delta*other.count/total
+        self.m2 += other.m2 + delta**2*self.count*other.count/total
+        self.count = total
+        return None
+
+    @property
+    def variance(self):
+        return self.m2/self.count if self.count else float('nan')
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance))
+
+    def to_dict(self):
+        return {'count':self.count,'mean':self.mean,'m2':self.m2}
+
+class TDigest():
+    '''
+    Merging t-digest quantile sketch. Keeps a bounded number of centroids that are smallest near the tails,
+    so high quantiles like the anomaly threshold stay accurate. Digests from several workers can be merged
+
+    compression : controls the number of centroids (about compression/2). larger is more accurate
+    buffer_size : number of raw values buffered before they are merged into the centroids
+    '''
+    def __init__(self,compression=500,buffer_size=10000):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.array([])
+        self.weights = np.array([])
+        self.buffer = []
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def update(self,x,weights=None):
+        x = np.asarray(x,dtype='float64').ravel()
+        keep = ~np.isnan(x)
+        weights = np.ones(len(x)) if weights is None else np.asarray(weights,dtype='float64').ravel()
+        x, weights = x[keep], weights[keep]
+        if len(x) == 0:
+            return None
+        self.buffer.append((x,weights))
+        self.count += float(weights.sum())
+        self.min = min(self.min,float(x.min()))
+        self.max = max(self.max,float(x.max()))
+        if sum(len(b[0]) for b in self.buffer) >= self.buffer_size:
+            self._compress()
+        return None
+
+    def _compress(self):
+        if len(self.buffer) == 0:
+            return None
+        means = np.concatenate([self.means] + [b[0] for b in self.buffer])
+        weights = np.concatenate([self.weights] + [b[1] for b in self.buffer])
+        self.buffer = []
+
+        order = np.argsort(means,kind='stable')
+        means, weights = means[order], weights[order]
+        # k1 scale function. clusters cover at most one unit of k, which is very little weight near q=0 and q=1
+        q = (np.cumsum(weights) - weights/2)/weights.sum()
+        k = self.compression/(2*np.pi)*np.arcsin(2*q - 1)
+        bins = np.floor(k - k.min())
+        starts = np.flatnonzero(np.r_[True,np.diff(bins) != 0])
+
+        self.weights = np.add.reduceat(weights,starts)
+        self.means = np.add.reduceat(means*weights,starts)/self.weights
+        return None
+
+    def merge(self,other):
+        other._compress()
+        if len(other.means):
+            self.buffer.append((other.means,other.weights))
+            self.count += other.count
+            self.min = min(self.min,other.min)
+            self.max = max(self.max,other.max)
+        self._compress()
+        return None
+
+    def quantile(self,q):
+        '''Approximate q quantile (0 <= q <= 1) of everything added so far'''
+        self._compress()
+        if len(self.means) == 0:
+            return float('nan')
+        # centroids sit at the middle of their weight. interpolate between them and out to the extremes
+        centers = np.cumsum(self.weights) - self.weights/2
+        ranks = np.r_[0.0,centers,self.weights.sum()]
+        values = np.r_[self.min,self.means,self.max]
+        return float(np.interp(q*self.weights.sum(),ranks,values))
+
+    def to_dict(self):
+        self._compress()
+        return {'compression':self.compression,'count':self.count,'min':self.min,'max':self.max,
+                'means':self.means.tolist(),'weights':self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls,d):
+        digest = cls(compression=d['compression'])
+        digest.means = np.asarray(d['means'],dtype='float64')
+        digest.weights = np.asarray(d['weights'],dtype='float64')
+        digest.count = d['count']
+        digest.min = d['min']
+        digest.max = d['max']
+        return digest
+
+class ThresholdCalibrator():
+    '''
+    Collects reconstruction loss statistics batch by batch so the threshold never needs every loss in memory
+    Keeps moments and a quantile sketch overall and optionally per segment (e.g. per event type)
+    Calibrators from several workers can be merged
+
+    compression : t-digest compression. larger is more accurate
+    '''
+    def __init__(self,compression=500):
+        self.compression = compression
+        self.moments = Moments()
+        self.sketch = TDigest(compression=compression)
+        self.segments = {}
+
+    @instrumented('threshold_update')
+    def update(self,loss,segments=None):
+        '''
+        Adds a batch of reconstruction losses
+        segments : optional array with the segment of every loss for per segment thresholds
+        '''
+        loss = np.asarray(loss,dtype='float64').ravel()
+        self.moments.update(loss)
+        self.sketch.update(loss)
+
+        if segments is not None:
+            segments = np.asarray(segments).ravel()
+            for s in np.unique(segments):
+                moments, sketch = self.segments.setdefault(str(s),(Moments(),TDigest(compression=self.compression)))
+                moments.update(loss[segments == s])
+                sketch.update(loss[segments == s])
+        return None
+
+    @instrumented('threshold_fit')
+    def fit(self,autoencoder,batches,segments=None):
+        '''
+        Runs the autoencoder over an iterable of processed batches and adds their mean absolute reconstruction errors
+        segments : optional iterable of segment arrays matching the batches
+        '''
+        segment_iter = iter(segments if segments is not None else [])
+        for batch in batches:
+            reconstructed = np.asarray(autoencoder(batch,training=False))
+            loss = np.mean(np.abs(reconstructed - np.asarray(batch)),axis=-1)
+            self.update(loss,next(segment_iter,None))
+        return None
+
+    def merge(self,other):
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        for s,(moments,sketch) in other.segments.items():
+            mine = self.segments.setdefault(s,(Moments(),TDigest(compression=self.compression)))
+            mine[0].merge(moments)
+            mine[1].merge(sketch)
+        return None
+
+    def threshold(self,method='std',n_std=1.0,q=0.99,segment=None):
+        '''
+        Threshold for the whole data or a single segment
+        method 'std' is mean + n_std standard deviations (the original training script threshold)
+        method 'quantile' is the q quantile of the losses
+        '''
+        moments, sketch = (self.moments,self.sketch) if segment is None else self.segments[str(segment)]
+        if method == 'std':
+            return moments.mean + n_std*moments.std
+        elif method == 'quantile':
+            return sketch.quantile(q)
+        raise ValueError(f'Threshold method {method} not currently supported')
+
+    def segment_thresholds(self,method='std',n_std=1.0,q=0.99):
+        return {s:self.threshold(method=method,n_std=n_std,q=q,segment=s) for s in self.segments}
+
+    def save(self,fname):
+        '''Saves the calibration state. Usually next to model_stats.json, e.g. models/<model>/calibration.json'''
+        state = {'compression':self.compression,
+                'moments':self.moments.to_dict(),
+                'sketch':self.sketch.to_dict(),
+                'segments':{s:{'moments':m.to_dict(),'sketch':sk.to_dict()} for s,(m,sk) in self.segments.items()}
+                }
+        with open(fname,'w') as f:
+            json.dump(state,f)
+        return None
+
+    @classmethod
+    def load(cls,fname):
+        with open(fname,'r') as f:
+            state = json.load(f)
+        calibrator = cls(compression=state['compression'])
+        calibrator.moments = Moments(**state['moments'])
+        calibrator.sketch = TDigest.from_dict(state['sketch'])
+        calibrator.segments = {s:(Moments(**v['moments']),TDigest.from_dict(v['sketch'])) for s,v in state['segments'].items()}
+        return calibrator
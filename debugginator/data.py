@@ -5,124 +5,130 @@ Classes and functions to extract and preprocess data for debuggination
 Created by: Andrew Younger
 2022-03-24
 '''
+import os
+import glob
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-import tensorflow as tf
-from tensorflow.keras import layers, losses
-from tensorflow.keras.models import Model
+from debugginator.cache import ExtractCache
+from debugginator.instrument import instrumented
 
-class Preprocesser():
-    '''
-    Preprocesser class takes a pandas dataframe as input and additional arguments to specify the encoding needed for the column
-    Used like a general model except done on a specific dataframe not a general object
-
-    df : pandas dataframe input argument
-    categorical_features : optional arugment to specify which columns should be vectorized. defaults to empty list
-    numerical_features : optional argument to specify which columns should be normalized. defaults to empty list
-
-    predict method : takes an array of the correct size and perfroms the preprocessing
-    train method : uses the input df to train the preprocesser
-    '''
-    def __init__(self,df,categorical_features=[],numerical_features=[]):
-        self.df = df
-        self.categorical_features = categorical_features
-        self.numerical_features = numerical_features
-        self.normalized_features = []
-        self.numerical_inputs = []
-        self.categorical_inputs = []
-        self.encoded_features = []
-        self.model = None
-        
-        if len(self.categorical_features) == 0:
-            self.categorical_features = [c for c in self.df.columns if self.df[c].dtype not in ['int64','float64']]
-        if len(self.numerical_features) == 0:
-            self.numerical_features = [c for c in self.df.columns if self.df[c].dtype in ['int64','float64']]
-
-    def normalize(self):
-        '''
-        Normalizes the numerical features of the dataframe. Resets the normalization attributes to empty.
-        '''
-        self.normalized_features = []
-        self.numerical_inputs = []
-        for n in self.numerical_features:
-            ninput = layers.Input(shape=(1,),dtype=tf.float32)
-            normalizer = layers.Normalization()
-            normalizer.adapt(self.df[n])
-            normalized_data = normalizer(ninput)
-            self.numerical_inputs.append(ninput)
-            self.normalized_features.append(normalized_data)
-
-        print(f'Normalized {len(self.numerical_features)} of {len(self.df.columns)} total columns')
-
-    def encode(self):
-        '''
-        Encodes the categorical features of the dataframe. Resets the encoding attributes to empty
-        Currently only supports one-hot encoding of features
-        '''
-        self.categorical_inputs = []
-        self.encoded_features = []
-        for c in self.categorical_features:
-            cinput = layers.Input(shape=(1,),dtype=tf.string)
-            encoder = layers.StringLookup(output_mode='one_hot')
-            encoder.adapt(self.df[c].astype(str))
-            encoded = encoder(cinput)
-            self.categorical_inputs.append(cinput)
-            self.encoded_features.append(encoded)
-
-        print(f'Encoded {len(self.categorical_features)} of {len(self.df.columns)} total columns')
+DEFAULT_COLUMNS_PATH = '/root/thedebugginator/data/raw/default_columns.txt'
 
-    def train(self):
-        '''
-        Train the preprocesser to accept inputs in the same form as its own df
-        Assigns a model to the preprocesser that can be used to predict things
-        '''
-        # check if the encoded features and/or normalized features exist and are not empty.
-        if len(self.encoded_features) == 0:
-            self.encode()
-        if len(self.normalized_features) == 0:
-            self.normalize()
+# the preprocessing classes need tensorflow. they are only imported when first used so extraction starts fast
+_LAZY = {'Preprocesser','FusedPreprocessing'}
 
-        output = layers.concatenate(self.normalized_features + self.encoded_features)
-        self.model = Model(inputs=self.numerical_inputs+self.categorical_inputs,outputs=[output])
-        print('Preprocess training finished')
+def __getattr__(name):
+    if name in _LAZY:
+        import debugginator.preprocessing
+        return getattr(debugginator.preprocessing,name)
+    raise AttributeError(f'module {__name__} has no attribute {name}')
 
-        predicted = self.predict(self.df)
-        print(f'Original dimensions: {self.df.shape}')
-        print(f'Encoded dimensions: {predicted.shape}')
-
-        return None
-
-    def predict(self,x,numerical_features=None,categorical_features=None):
-        if self.model is None:
-            raise AttributeError('No trained model to make predictions. Run Preprocesser.train() first')
-
-        numericals = numerical_feautres or self.numerical_features
-        categoricals = categorical_features or self.categorical_features
+@lru_cache(maxsize=None)
+def _load_droplist(datapath,mtime):
+    '''
+    Reads the list of default columns to drop. Cached on the file path and modification time so the file is only read once
+    '''
+    with open(datapath,'r') as f:
+        droplist = [x.split()[0] for x in f.readlines() if x.strip()]
+    return frozenset(droplist)
 
-        predict_list = [x[c] for c in numericals + categoricals]
-        return self.model.predict(predict_list)
+def load_droplist(datapath=DEFAULT_COLUMNS_PATH):
+    return _load_droplist(datapath,os.path.getmtime(datapath))
 
-    def save(self,fname,fpath='/root/thedebugginator/models'):
-        if self.model is None:
-            raise AttributeError('No existing model to save.')
-        self.model.save(f'{fpath}/{fname}')
+def default_keep_columns(columns,datapath=DEFAULT_COLUMNS_PATH):
+    '''
+    Returns a dict of original column name -> short column name for the columns kept by the default extraction
+    The short name is just the last part after . in the original column names
+    Columns with "context" in the name and columns listed in datapath are dropped
+    '''
+    droplist = load_droplist(datapath)
+    keep = {}
+    for c in columns:
+        name = str(c).split('.')[-1]
+        if "context" in name.lower() or name.lower() in droplist:
+            continue
+        keep[c] = name
+    return keep
+
+def _tag_source(df,i,paths,source_col):
+    '''Adds the source file of every row as a categorical column so the paths are stored once, not per row'''
+    if source_col is not None:
+        with pd.option_context('mode.chained_assignment',None):
+            df[source_col] = pd.Categorical.from_codes(np.full(len(df),i,dtype='int32'),categories=paths)
+    return df
+
+def _read_source(ftype,cache,path,i,paths,source_col,options):
+    '''Reads one of the files of a multi file get_df. Module level so process pools can pickle it'''
+    df = PandasExtractor(ftype=ftype,cache=cache).get_df(path,**options)
+    return _tag_source(df,i,paths,source_col)
 
 class Extractor():
-    def __new__(self,pyspark=False,ftype=None):
+    def __new__(self,pyspark=False,ftype=None,cache=None,**kwargs):
         if pyspark:
-            return PySparkExtractor()
+            return PySparkExtractor(ftype=ftype,**kwargs)
         else:
-            return PandasExtractor(ftype=ftype)
+            return PandasExtractor(ftype=ftype,cache=cache)
 
 class PandasExtractor():
     '''
     ftype: optional parameter to specify the type of fstring given (pandas readable). defaults to None
+    cache: optional ExtractCache or cache directory. Full reads are stored in and loaded from the cache when given
     '''
-    def __init__(self,ftype=None):
+    def __init__(self,ftype=None,cache=None):
         self.ftype = ftype
+        if isinstance(cache,str):
+            cache = ExtractCache(cache_dir=cache)
+        self.cache = cache
         
-    def get_df(self,fstring,feature_cols=[],exclude_cols=[],**kwargs):
+    @instrumented('extract',chunks=True)
+    def get_df(self,fstring,feature_cols=[],exclude_cols=[],chunksize=None,extract_default=False,dtypes=None,datapath=DEFAULT_COLUMNS_PATH,
+            workers=None,executor='threads',source_col='source_file',stream=False,**kwargs):
+        '''
+        Reads the file into a dataframe
+        fstring can also be a glob or a list of paths/globs. The files are then parsed in parallel and every row is tagged with its file
+        chunksize: optional number of rows per chunk. When given returns an iterator of dataframes instead of one dataframe
+                   excel has no chunked reader, its chunks are slices of the whole parsed sheet
+        extract_default: apply the default extraction while reading so dropped columns are never parsed
+        dtypes: optional dict of short column name -> dtype used when extract_default is set
+        datapath: list of default columns to drop when extract_default is set
+        workers: number of files parsed at once for multiple files. defaults to the number of cores
+        executor: 'threads' (default) or 'processes' to parse multiple files in a process pool
+        source_col: column that gets the source file of every row for multiple files. None to leave it out
+        stream: for multiple files return an iterator of one dataframe per file, in file order, instead of concatenating them
+                concatenating needs every per file frame and the result in memory at once, about twice the data.
+                stream=True never copies and holds at most twice the workers frames, so use it when the data is near the memory limit
+        '''
+        paths = self._expand(fstring)
+        if paths is not None:
+            options = dict(feature_cols=feature_cols,exclude_cols=exclude_cols,extract_default=extract_default,dtypes=dtypes,datapath=datapath,**kwargs)
+            return self._get_many(paths,chunksize,workers,executor,source_col,stream,options)
+
         ftype = self.ftype or fstring.split('.')[-1]
 
+        cache_key = None
+        if self.cache is not None and chunksize is None:
+            # the default extraction depends on the droplist file, so an edited droplist must miss the cache
+            depends = [datapath] if extract_default else []
+            cache_key = self.cache.key(fstring,depends=depends,extract_default=extract_default,dtypes=dtypes,datapath=datapath,**kwargs)
+            df = self.cache.load(cache_key)
+            if df is not None:
+                return self._finish(df,feature_cols,exclude_cols)
+
+        rename = None
+        if extract_default:
+            rename = self._default_projection(fstring,ftype,dtypes,datapath,kwargs)
+
+        if chunksize is not None:
+            chunks = self._read_chunks(fstring,ftype,chunksize,**kwargs)
+            if extract_default:
+                chunks = (self._project(chunk,rename,dtypes,datapath) for chunk in chunks)
+            if (self._lencheck(feature_cols) or self._lencheck(exclude_cols)):
+                return self.extract_features(df=chunks,feature_cols=feature_cols,exclude_cols=exclude_cols)
+            return chunks
+
         if ftype == 'csv' or ftype == 'txt':
             df = pd.read_csv(fstring,**kwargs)
         elif ftype in ['xlsx','xlsm','xlsb','xls']:
@@ -131,25 +137,142 @@ class PandasExtractor():
             df = pd.read_json(fstring,**kwargs)
         else:
             raise ValueError(f'File type {ftype} not currently supported')
+        if extract_default:
+            df = self._project(df,rename,dtypes,datapath)
+        if cache_key is not None:
+            self.cache.save(cache_key,df,source=fstring)
+        return self._finish(df,feature_cols,exclude_cols)
+
+    def _expand(self,fstring):
+        '''File paths of a glob or list of paths/globs, sorted within each glob. None for a single plain path'''
+        if isinstance(fstring,str) and not any(c in fstring for c in '*?['):
+            return None
+        paths = []
+        for pattern in ([fstring] if isinstance(fstring,str) else fstring):
+            paths += sorted(glob.glob(pattern)) if any(c in pattern for c in '*?[') else [pattern]
+        if len(paths) == 0:
+            raise FileNotFoundError(f'No files match {fstring}')
+        return paths
+
+    def _get_many(self,paths,chunksize,workers,executor,source_col,stream,options):
+        if chunksize is not None:
+            # one file after another so only one chunk is in memory at a time
+            return self._chunks_of_many(paths,chunksize,source_col,options)
+
+        frames = self._read_many(paths,workers,executor,source_col,options)
+        if stream:
+            return frames
+        # pd.concat always copies, so the peak is every per file frame plus the result. stream=True avoids the copy
+        df = pd.concat(list(frames),ignore_index=True)
+        self.df = df
+        return df
+
+    def _chunks_of_many(self,paths,chunksize,source_col,options):
+        for i,path in enumerate(paths):
+            for chunk in PandasExtractor(ftype=self.ftype).get_df(path,chunksize=chunksize,**options):
+                yield _tag_source(chunk,i,paths,source_col)
+
+    def _read_many(self,paths,workers,executor,source_col,options):
+        '''Parses the files in a pool and yields them in file order, keeping at most twice the workers in flight'''
+        if executor not in ['threads','processes']:
+            raise ValueError(f'Executor {executor} not currently supported')
+        workers = workers or min(len(paths),os.cpu_count() or 1)
+        pool_class = ProcessPoolExecutor if executor == 'processes' else ThreadPoolExecutor
+        with pool_class(max_workers=workers) as pool:
+            futures = deque()
+            for i,path in enumerate(paths):
+                futures.append(pool.submit(_read_source,self.ftype,self.cache,path,i,paths,source_col,options))
+                if len(futures) >= 2*workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def _finish(self,df,feature_cols,exclude_cols):
         self.df = df 
         if (self._lencheck(feature_cols) or self._lencheck(exclude_cols)):
             self.tdf = self.extract_features(df=df,feature_cols=feature_cols,exclude_cols=exclude_cols)
             return self.tdf
         return df
 
+    def _default_projection(self,fstring,ftype,dtypes,datapath,kwargs):
+        '''
+        Works out the default extraction from the header only and pushes it into the reader kwargs
+        Returns the mapping of original column name -> short column name
+        '''
+        if ftype == 'csv' or ftype == 'txt':
+            header = pd.read_csv(fstring,nrows=0,**kwargs).columns
+        elif ftype in ['xlsx','xlsm','xlsb','xls']:
+            header = pd.read_excel(fstring,nrows=0,**kwargs).columns
+        elif ftype == 'json':
+            # json readers can't skip columns so the projection happens right after parsing
+            return None
+        else:
+            raise ValueError(f'File type {ftype} not currently supported')
+
+        rename = default_keep_columns(header,datapath=datapath)
+        kwargs['usecols'] = list(rename)
+        if dtypes:
+            kwargs['dtype'] = {c:dtypes[n] for c,n in rename.items() if n in dtypes}
+        return rename
+
+    def _project(self,df,rename,dtypes,datapath):
+        '''
+        Applies the default extraction to a df that was read with the projection already pushed down
+        rename is None for readers that can't push it down (json), those get the full default extraction and dtypes here
+        '''
+        if rename is None:
+            df = self.default_extraction(df=df,datapath=datapath)
+            if dtypes:
+                df = df.astype({n:dtypes[n] for n in df.columns if n in dtypes})
+            return df
+        df.columns = [rename[c] for c in df.columns]
+        return df
+
+    def _read_chunks(self,fstring,ftype,chunksize,**kwargs):
+        '''
+        Generator of dataframes with at most chunksize rows each
+        json files must be line delimited to be read in chunks
+        excel files are parsed whole and then sliced, so chunking them doesn't bound memory
+        '''
+        if ftype == 'csv' or ftype == 'txt':
+            with pd.read_csv(fstring,chunksize=chunksize,**kwargs) as reader:
+                for chunk in reader:
+                    yield chunk
+        elif ftype in ['xlsx','xlsm','xlsb','xls']:
+            # excel has no chunked reader and every skiprows read parses the sheet from the top again,
+            # so the sheet is parsed once and handed out in slices. the whole sheet is in memory while it is
+            df = pd.read_excel(fstring,**kwargs)
+            for start in range(0,len(df),chunksize):
+                yield df.iloc[start:start+chunksize]
+        elif ftype == 'json':
+            kwargs.setdefault('lines',True)
+            if not kwargs['lines']:
+                raise ValueError('Only line delimited json files can be read in chunks')
+            with pd.read_json(fstring,chunksize=chunksize,**kwargs) as reader:
+                for chunk in reader:
+                    yield chunk
+        else:
+            raise ValueError(f'File type {ftype} not currently supported')
+
     def _lencheck(self,x):
         return len(x) > 0
 
-    def extract_features(self,df=None,feature_cols=[],exclude_cols=[],inplace=False):
-        if df is None:
-            df = self.df.copy()
+    def _is_chunked(self,df):
+        return df is not None and not isinstance(df,pd.DataFrame)
 
+    def extract_features(self,df=None,feature_cols=[],exclude_cols=[],inplace=False):
         use_feature_cols = self._lencheck(feature_cols)
         use_exclude_cols = self._lencheck(exclude_cols)
 
         if not (use_feature_cols or use_exclude_cols):
             raise ValueError('No feature columns to extract')
 
+        if self._is_chunked(df):
+            return (self.extract_features(df=chunk,feature_cols=feature_cols,exclude_cols=exclude_cols) for chunk in df)
+
+        if df is None:
+            df = self.df.copy()
+
         tdf = df.drop(exclude_cols,axis=1)
         if use_feature_cols:
             tdf = tdf[feature_cols]
@@ -175,48 +298,167 @@ class PandasExtractor():
         print(f'Saved dataframe to {savepath}')
         return None
 
-    def default_extraction(self,df=None,datapath='/root/thedebugginator/data/raw/default_columns.txt'):
+    @instrumented('default_extraction')
+    def default_extraction(self,df=None,datapath=DEFAULT_COLUMNS_PATH):
+        '''
+        Keeps the useful columns of a raw extract and renames them to the last part after . in the original column names
+        df can also be an iterator of dataframe chunks (see get_df chunksize) in which case an iterator of chunks is returned
+        Use get_df(extract_default=True) to skip parsing the dropped columns altogether
+        '''
+        if self._is_chunked(df):
+            return (self.default_extraction(df=chunk,datapath=datapath) for chunk in df)
+
         if df is None:
-            df = self.df.copy()
-        
-        # by default the column name is just the last part after . in the original column names
-        df.columns = [x.split('.')[-1] for x in df.columns]
+            df = self.df
 
-        # remove any columns that have "context" in the name
-        no_context_cols = [x for x in df.columns if "context" not in x.lower()]
+        # remove any columns that have "context" in the name and the list of default columns (list found in the datafiles)
+        keep = default_keep_columns(df.columns,datapath=datapath)
 
-        # remove list of default columns (list found in the datafiles)
-        with open(datapath,'r') as f:
-            droplist = f.readlines()
-            droplist = [x.split()[0] for x in droplist]
-            
-        keep_cols = [x for x in no_context_cols if x.lower() not in droplist]
+        # selecting the kept columns makes the only copy so the input dataframe is left untouched
+        tdf = df[list(keep)]
+        tdf.columns = list(keep.values())
 
-        return df[keep_cols]
+        return tdf
 
-# TODO: make this work    
 class PySparkExtractor():
     '''
-    PySpark extractor class that will extract the data from a pyspark dataframe
+    Extracts data with Spark so very large exports are read and filtered on every core
+    Returns Spark dataframes. to_pandas_chunks hands them to the Preprocesser as pandas chunks through Arrow
+    Needs the spark extra (pip install debugginator[spark]) for pyspark
+
+    ftype: optional parameter to specify the type of fstring given (csv, json or parquet). defaults to None
+    master: optional spark master url. defaults to local[*] which uses every local core
+    spark: optional existing SparkSession to use instead of creating one
+    conf: any other spark config, e.g. {'spark.driver.memory':'8g'}
     '''
-    def __init__(self):
-        return None
+    def __init__(self,ftype=None,master='local[*]',spark=None,conf={}):
+        self.ftype = ftype
+        if spark is None:
+            from pyspark.sql import SparkSession
+            builder = SparkSession.builder.master(master).appName('debugginator')
+            builder = builder.config('spark.sql.execution.arrow.pyspark.enabled','true')
+            for k,v in conf.items():
+                builder = builder.config(k,v)
+            spark = builder.getOrCreate()
+        self.spark = spark
+        self.df = None
+
+    @staticmethod
+    def _col(name):
+        # raw extract columns have dots in their names, which spark would read as struct fields
+        from pyspark.sql.functions import col
+        return col(f'`{name}`')
+
+    @instrumented('extract')
+    def get_df(self,fstring,feature_cols=[],exclude_cols=[],extract_default=False,datapath=DEFAULT_COLUMNS_PATH,**kwargs):
+        '''
+        Reads the file, directory or glob of files into a spark dataframe
+        Nothing is read until the dataframe is used, so the extraction steps are pushed down into the read
+        extract_default: apply the default extraction
+        datapath: list of default columns to drop when extract_default is set
+        '''
+        ftype = self.ftype or fstring.rstrip('/').split('.')[-1]
+        if ftype == 'csv' or ftype == 'txt':
+            kwargs.setdefault('header',True)
+            kwargs.setdefault('inferSchema',True)
+            df = self.spark.read.csv(fstring,**kwargs)
+        elif ftype == 'json':
+            df = self.spark.read.json(fstring,**kwargs)
+        elif ftype == 'parquet':
+            df = self.spark.read.parquet(fstring,**kwargs)
+        else:
+            raise ValueError(f'File type {ftype} not currently supported')
 
-    def get_df():
-        return None
+        if extract_default:
+            df = self.default_extraction(df=df,datapath=datapath)
+        self.df = df
+        if (self._lencheck(feature_cols) or self._lencheck(exclude_cols)):
+            self.tdf = self.extract_features(df=df,feature_cols=feature_cols,exclude_cols=exclude_cols)
+            return self.tdf
+        return df
 
-    def _lencheck():
-        return None
+    def _lencheck(self,x):
+        return len(x) > 0
 
-    def extract_features():
-        return None
+    def extract_features(self,df=None,feature_cols=[],exclude_cols=[],inplace=False):
+        use_feature_cols = self._lencheck(feature_cols)
+        use_exclude_cols = self._lencheck(exclude_cols)
 
-    def save_df():
-        return None
+        if not (use_feature_cols or use_exclude_cols):
+            raise ValueError('No feature columns to extract')
 
-    def _default_extraction():
+        if df is None:
+            df = self.df
+
+        tdf = df.drop(*exclude_cols)
+        if use_feature_cols:
+            tdf = tdf.select([self._col(c) for c in feature_cols])
+        self.tdf = tdf
+
+        if inplace==True:
+            self.df = self.tdf
+            return None
+        return tdf
+
+    def save_df(self,df,savepath,mode='overwrite',**kwargs):
+        '''
+        Writes the dataframe with one file per partition into the savepath directory
+        mode: spark save mode. defaults to overwrite
+        '''
+        ftype = savepath.rstrip('/').split('.')[-1]
+
+        if ftype == 'csv' or ftype == 'txt':
+            kwargs.setdefault('header',True)
+            df.write.csv(savepath,mode=mode,**kwargs)
+        elif ftype == 'json':
+            df.write.json(savepath,mode=mode,**kwargs)
+        elif ftype == 'parquet':
+            df.write.parquet(savepath,mode=mode,**kwargs)
+        else:
+            raise ValueError(f'File type {ftype} not currently supported')
+
+        print(f'Saved dataframe to {savepath}')
         return None
 
+    @instrumented('default_extraction')
+    def default_extraction(self,df=None,datapath=DEFAULT_COLUMNS_PATH):
+        '''
+        Keeps the useful columns of a raw extract and renames them to the last part after . in the original column names
+        Same columns as PandasExtractor.default_extraction
+        '''
+        if df is None:
+            df = self.df
+
+        keep = default_keep_columns(df.columns,datapath=datapath)
+        return df.select([self._col(c).alias(n) for c,n in keep.items()])
+
+    def to_pandas_chunks(self,df=None,chunksize=100000,staging_dir=None):
+        '''
+        Hands a spark dataframe to pandas as an iterator of dataframes with at most chunksize rows,
+        e.g. Preprocesser(extractor.to_pandas_chunks(df)) or training_dataset(preprocesser,lambda: extractor.to_pandas_chunks(df))
+
+        Spark writes the dataframe as parquet in parallel, then the files are read back as Arrow record batches
+        so the driver only ever holds one chunk. The staging files are removed once the iterator is exhausted or closed
+        staging_dir: optional directory for the staging files. must be visible to the driver and the executors. defaults to a temp dir
+        '''
+        import shutil
+        import tempfile
+        import pyarrow.dataset
+
+        if df is None:
+            df = self.df
+
+        temporary = staging_dir is None
+        staging_dir = staging_dir or tempfile.mkdtemp(prefix='debugginator_spark_')
+        path = os.path.join(staging_dir,'chunks.parquet')
+        try:
+            df.write.parquet(path,mode='overwrite')
+            for batch in pyarrow.dataset.dataset(path,format='parquet').to_batches(batch_size=chunksize):
+                if batch.num_rows > 0:
+                    yield batch.to_pandas()
+        finally:
+            shutil.rmtree(staging_dir if temporary else path,ignore_errors=True)
+
 def main():
     return True
 
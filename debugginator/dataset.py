@@ -0,0 +1,184 @@
+#-*- coding: utf-8 -*-
+'''
+Binary format for processed datasets. A directory of float32 .npy shards plus a metadata.json header
+with the row count, dtype and the map from output columns back to the Preprocesser features
+
+Shards are opened with np.load(mmap_mode='r') so rows are sliced from disk without loading the whole matrix
+'''
+import os
+import json
+import numpy as np
+
+FORMAT_VERSION = 1
+METADATA = 'metadata.json'
+OOV_TOKEN = '[UNK]'
+
+def feature_columns(preprocesser):
+    '''
+    Output column names of a trained Preprocesser in the order it outputs them
+    Numerical features keep their name, encoded categorical features become feature=token (or feature#bin when hashed)
+    Returns the column names and a dict of feature -> [first column, last column + 1]
+    '''
+    columns = list(preprocesser.numerical_features)
+    features = {n:[i,i+1] for i,n in enumerate(preprocesser.numerical_features)}
+    for c in preprocesser.categorical_features:
+        start = len(columns)
+        if preprocesser.encoding == 'hash':
+            columns += [f'{c}#{i}' for i in range(preprocesser.num_bins)]
+        else:
+            columns += [f'{c}={t}' for t in [OOV_TOKEN] + list(preprocesser.vocabularies[c])]
+        features[c] = [start,len(columns)]
+    return columns, features
+
+class ProcessedWriter():
+    '''
+    Writes a processed matrix batch by batch into fixed size shards
+
+    path : directory of the dataset. created if it doesn't exist
+    preprocesser : optional trained Preprocesser to store the column map of
+    shard_rows : rows per shard file
+    dtype : dtype of the stored values. defaults to float32
+    '''
+    def __init__(self,path,preprocesser=None,shard_rows=1_000_000,dtype='float32'):
+        self.path = path
+        self.shard_rows = shard_rows
+        self.dtype = np.dtype(dtype)
+        self.columns, self.features = feature_columns(preprocesser) if preprocesser is not None else (None,None)
+        self.shards = []
+        self.rows = 0
+        self.width = None
+        self.pending = []
+        self.pending_rows = 0
+        os.makedirs(self.path,exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def append(self,matrix):
+        '''Adds rows to the dataset. full shards are written as soon as they fill up'''
+        matrix = np.asarray(matrix,dtype=self.dtype)
+        if self.width is None:
+            self.width = matrix.shape[1]
+            if self.columns is not None and len(self.columns) != self.width:
+                raise ValueError(f'Matrix has {self.width} columns but the preprocesser outputs {len(self.columns)}')
+        elif matrix.shape[1] != self.width:
+            raise ValueError(f'Expected {self.width} columns, got {matrix.shape[1]}')
+
+        self.pending.append(matrix)
+        self.pending_rows += len(matrix)
+        if self.pending_rows >= self.shard_rows:
+            pending = np.concatenate(self.pending)
+            full = len(pending) - len(pending) % self.shard_rows
+            for start in range(0,full,self.shard_rows):
+                self._write_shard(pending[start:start+self.shard_rows])
+            self.pending = [pending[full:]]
+            self.pending_rows = len(pending) - full
+        return None
+
+    def _write_shard(self,shard):
+        fname = f'shard_{len(self.shards):05d}.npy'
+        np.save(os.path.join(self.path,fname),shard)
+        self.shards.append({'file':fname,'rows':len(shard)})
+        self.rows += len(shard)
+
+    def close(self):
+        '''Writes the last partial shard and the metadata header'''
+        if self.pending_rows > 0:
+            self._write_shard(np.concatenate(self.pending))
+        self.pending = []
+        self.pending_rows = 0
+        metadata = {'version':FORMAT_VERSION,
+                'dtype':self.dtype.str,
+                'rows':self.rows,
+                'width':self.width,
+                'shard_rows':self.shard_rows,
+                'shards':self.shards,
+                'columns':self.columns,
+                'features':self.features
+                }
+        with open(os.path.join(self.path,METADATA),'w') as f:
+            json.dump(metadata,f,indent=4)
+        return None
+
+def write_processed(matrix,path,preprocesser=None,shard_rows=1_000_000):
+    '''Saves a whole processed matrix (or an iterable of processed batches) as a sharded dataset'''
+    with ProcessedWriter(path,preprocesser=preprocesser,shard_rows=shard_rows) as writer:
+        if isinstance(matrix,np.ndarray):
+            matrix = [matrix]
+        for batch in matrix:
+            writer.append(batch)
+    return path
+
+class ProcessedDataset():
+    '''
+    Read side of the format. Shards are memory-mapped when the dataset is opened
+
+    Indexing with a row slice returns a zero-copy view when the rows sit in one shard and a copy when they span shards
+    dataset[rows, columns] takes any numpy column index after the rows
+    '''
+    def __init__(self,path):
+        self.path = path
+        with open(os.path.join(path,METADATA),'r') as f:
+            self.metadata = json.load(f)
+        if self.metadata['version'] != FORMAT_VERSION:
+            raise ValueError(f'Unsupported processed dataset version {self.metadata["version"]}')
+        self.columns = self.metadata['columns']
+        self.features = self.metadata['features']
+        self.dtype = np.dtype(self.metadata['dtype'])
+        self.shards = [np.load(os.path.join(path,s['file']),mmap_mode='r') for s in self.metadata['shards']]
+        self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),self.metadata['width'])
+
+    def _rows(self,start,stop):
+        if start >= stop:
+            return np.empty((0,self.metadata['width']),dtype=self.dtype)
+        first = int(np.searchsorted(self.offsets,start,side='right')) - 1
+        last = int(np.searchsorted(self.offsets,stop,side='left')) - 1
+        if first == last:
+            return self.shards[first][start - self.offsets[first]:stop - self.offsets[first]]
+        parts = [self.shards[first][start - self.offsets[first]:]]
+        parts += self.shards[first+1:last]
+        parts.append(self.shards[last][:stop - self.offsets[last]])
+        return np.concatenate(parts)
+
+    def __getitem__(self,key):
+        rows, columns = key if isinstance(key,tuple) else (key,slice(None))
+        if isinstance(rows,slice):
+            start, stop, step = rows.indices(len(self))
+            result = self._rows(start,stop)[::step] if step > 0 else self._rows(stop + 1,start + 1)[::step]
+        elif np.ndim(rows) == 0:
+            rows = int(rows) + (len(self) if rows < 0 else 0)
+            result = self._rows(rows,rows + 1)[0]
+        else:
+            # fancy row indexing gathers shard by shard
+            rows = np.asarray(rows)
+            rows = np.where(rows < 0,rows + len(self),rows) if rows.dtype != bool else np.flatnonzero(rows)
+            shard = np.searchsorted(self.offsets,rows,side='right') - 1
+            result = np.empty((len(rows),self.metadata['width']),dtype=self.dtype)
+            for s in np.unique(shard):
+                mask = shard == s
+                result[mask] = self.shards[s][rows[mask] - self.offsets[s]]
+        return result[...,columns] if not (isinstance(columns,slice) and columns == slice(None)) else result
+
+    def feature(self,name,rows=slice(None)):
+        '''Output columns of one Preprocesser feature'''
+        if self.features is None:
+            raise AttributeError('No column map stored with this dataset')
+        start, stop = self.features[name]
+        return self[rows,start:stop]
+
+    def batches(self,batch_size=4096):
+        '''Consecutive row batches. views into the shards unless a batch spans two shards'''
+        for start in range(0,len(self),batch_size):
+            yield self._rows(start,min(start + batch_size,len(self)))
@@ -1,11 +1,154 @@
 # -*- coding: utf-8 -*-
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import json
+import itertools
 import pandas as pd
 import numpy as np
-from abc import ABC, abstractmethod
-import smtplib
-from email.mime.text import MIMEText
+from debugginator.edo.notify import FrequencyDegrade, Notifier
+from debugginator.instrument import instrumented
+
+def _key_values(df,col):
+    '''Values of a group key whether it is a column or an index level'''
+    if col in df.columns:
+        return df[col]
+    return pd.Series(df.index.get_level_values(col))
+
+def _group_codes(df,gcols):
+    '''
+    Integer codes of each group key in sorted key order, one row per key
+    Also returns which rows have no missing keys, pandas groupby drops those
+    '''
+    codes = np.empty((len(gcols),len(df)),dtype='int64')
+    for i,c in enumerate(gcols):
+        codes[i] = pd.factorize(_key_values(df,c),sort=True)[0]
+    return codes, (codes >= 0).all(axis=0)
+
+def _argsort_keys(key,size):
+    '''Stable argsort of non negative int64 keys below size. 16 bit digits are radix sorted when the keys fit in two of them'''
+    if size > 2**32:
+        return np.argsort(key,kind='stable')
+    # numpy radix sorts 16 bit integers. sort least significant digit first
+    order = np.argsort((key & 0xFFFF).astype('uint16'),kind='stable')
+    if size > 2**16:
+        order = order[np.argsort((key[order] >> 16).astype('uint16'),kind='stable')]
+    return order
+
+def _sorted_groups(codes,valid):
+    '''
+    Stable order of the rows with valid keys sorted by the code rows (first row most significant) and the start of each group in it
+    Same order as np.lexsort(codes[::-1]). The codes are packed into one mixed radix int64 key so only one sort is needed,
+    lexsort is the fallback when the key would overflow
+    '''
+    if codes.shape[1] == 0:
+        return np.array([],dtype='int64'), np.array([],dtype='int64')
+    low = codes.min(axis=1)
+    sizes = codes.max(axis=1) - low + 1
+    total = 1
+    for size in sizes:
+        total *= int(size)
+    if total >= 2**63:
+        order = np.lexsort(codes[::-1])
+        order = order[valid[order]]
+        return order, _segment_starts(codes[:,order])
+
+    key = codes[0] - low[0]
+    for i in range(1,len(codes)):
+        key = key*sizes[i] + (codes[i] - low[i])
+    order = _argsort_keys(key,total)
+    order = order[valid[order]]
+    skey = key[order]
+    return order, np.flatnonzero(np.r_[True,skey[1:] != skey[:-1]]) if len(order) else np.array([],dtype='int64')
+
+def _segment_starts(scodes):
+    '''Start positions of runs of equal keys in sorted codes'''
+    if scodes.shape[1] == 0:
+        return np.array([],dtype='int64')
+    if scodes.shape[0] == 0:
+        return np.array([0])
+    change = (np.diff(scodes,axis=1) != 0).any(axis=0)
+    return np.flatnonzero(np.r_[True,change])
+
+def _group_index(df,gcols,rows):
+    '''Index of the grouped result built from the first row of each group'''
+    if len(gcols) == 1:
+        return pd.Index(_key_values(df,gcols[0]).to_numpy()[rows],name=gcols[0])
+    return pd.MultiIndex.from_arrays([_key_values(df,c).to_numpy()[rows] for c in gcols],names=gcols)
+
+def _qfactor(values,starts):
+    '''Q factor of values against the previous value, restarting at each segment start'''
+    prev = np.empty(len(values))
+    prev[1:] = values[:-1]
+    prev[starts[starts < len(values)]] = np.nan
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.abs(values - prev)/(prev + values)
+
+@dataclass
+class ShockState:
+    '''
+    Compact per group state carried between daily EDO runs
+    last : last frequency seen for each group key
+    buffers : last window-1 frequencies of each group key, oldest first, for the moving average
+    '''
+    gcols: list
+    window: int = 7
+    last: dict = field(default_factory=dict)
+    buffers: dict = field(default_factory=dict)
+
+    def save(self,fname):
+        records = [{'key':list(k),'last':self.last[k],'buffer':self.buffers.get(k,[])} for k in self.last]
+        with open(fname,'w') as f:
+            json.dump({'gcols':self.gcols,'window':self.window,'groups':records},f,indent=4)
+        return None
+
+    @classmethod
+    def load(cls,fname):
+        with open(fname,'r') as f:
+            contents = json.load(f)
+        state = cls(gcols=contents['gcols'],window=contents['window'])
+        for r in contents['groups']:
+            key = tuple(r['key'])
+            state.last[key] = r['last']
+            state.buffers[key] = r['buffer']
+        return state
+
+def _pyvalue(x):
+    '''Plain python value so group keys can be stored as json'''
+    return x.item() if hasattr(x,'item') else x
+
+def _ewma(values,starts,span):
+    '''Exponentially weighted mean per segment, same as pandas ewm(span=span).mean() with adjust=True'''
+    # scipy.signal takes over a second to import, only load it when ewma spans are asked for
+    from scipy.signal import lfilter
+    decay = 1 - 2/(span + 1)
+    notnan = ~np.isnan(values)
+    # weighted sums of the values and of the weights, both decaying by one step per row, in one pass over every segment
+    sums = lfilter([1.0],[1.0,-decay],np.vstack([np.where(notnan,values,0.0),notnan.astype('float64')]),axis=1)
+    # a segment's own sums are the running sums minus what was carried in from before its start, decayed to each row
+    ends = np.r_[starts[1:],len(values)]
+    first = np.repeat(starts,ends - starts)
+    carried = np.where(first > 0,sums[:,np.maximum(first - 1,0)],0.0)
+    sums = sums - carried*decay**(np.arange(len(values)) - first + 1)
+    # rows before the first value of their segment stay missing. checked on counts since the weight sum is only close to zero
+    seen = np.cumsum(notnan)
+    seen = seen - np.where(first > 0,seen[np.maximum(first - 1,0)],0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(seen > 0,sums[0]/sums[1],np.nan)
+
+def _time_left(scodes,tvalues,group_start,width):
+    '''
+    First row of every row's time window for rows sorted by group then time, from one searchsorted over every group
+    scodes are the rows' codes into the sorted distinct times tvalues. packed with the group number they make one increasing key
+    '''
+    group = np.cumsum(np.r_[False,group_start[1:] != group_start[:-1]]) if len(scodes) else np.array([],dtype='int64')
+    stride = len(tvalues) + 1
+    # number of distinct times up to each row's time and up to the start of its window
+    key = group*stride + scodes + 1
+    query = group*stride + np.searchsorted(tvalues,tvalues - width,side='right')[scodes]
+    return np.searchsorted(key,query,side='right')
+
+def _table_rows(args,kwargs,result):
+    return len(args[0])
 
 class EventTable(pd.DataFrame):
     '''
@@ -17,6 +160,7 @@ class EventTable(pd.DataFrame):
     def _constructor(self):
         return EventTable
     
+    @instrumented('edo_detect_shocks',rows=_table_rows)
     def detectShocks(self,p,freqcol='frequency',qcol='Q',gcols=[]):
         '''Determine where the daily frequency peaks or valleys. Corresponds to a given Q value (percent increase)'''
         if freqcol not in self.columns:
@@ -29,47 +173,237 @@ class EventTable(pd.DataFrame):
         
         return None
     
-    def getFrequency(self,gcols,mcols,how='sum'):
-        '''Get frequency for a given set of group columns. Options for how to aggregate (default sum) and which columns to measure (default all)'''
+    @instrumented('edo_frequency',rows=_table_rows)
+    def getFrequency(self,gcols,mcols,how='sum',qcols=None):
+        '''
+        Get frequency for a given set of group columns. Options for how to aggregate (default sum) and which columns to measure (default all)
+        qcols: optional group columns to also compute the Q factor with in the same pass. Should be a prefix of gcols[:-1] to reuse the sort
+        '''
         if len(mcols) != 2:
             raise ValueError('Measurement columns should have two values. E.g. ["count","duration"]')
+        if len(gcols) < 2:
+            raise ValueError('Group columns should have at least two values. The last one is averaged over')
+
+        if how != 'sum':
+            aggdict = {x:how for x in mcols}
+            freqdf =  self.groupby(gcols).agg(aggdict)
+            freqdf['frequency'] = freqdf[mcols[0]]/freqdf[mcols[1]]
             
-        aggdict = {x:how for x in mcols}
-        freqdf =  self.groupby(gcols).agg(aggdict)
-        freqdf['frequency'] = freqdf[mcols[0]]/freqdf[mcols[1]]
-        
-        freqdf = freqdf.groupby(gcols[:-1]).agg({'frequency':'mean'})
+            freqdf = freqdf.groupby(gcols[:-1]).agg({'frequency':'mean'})
+            freqdf = EventTable(freqdf)
+            if qcols is not None:
+                freqdf.getQFactor('frequency',gcols=qcols)
+            return freqdf
+
+        # sort once on the group keys then reduce each contiguous segment
+        codes, valid = _group_codes(self,gcols)
+        order, starts = _sorted_groups(codes,valid)
+        num = np.add.reduceat(np.nan_to_num(self[mcols[0]].to_numpy(dtype='float64')[order]),starts) if len(order) else np.array([])
+        den = np.add.reduceat(np.nan_to_num(self[mcols[1]].to_numpy(dtype='float64')[order]),starts) if len(order) else np.array([])
+        with np.errstate(divide='ignore',invalid='ignore'):
+            frequency = num/den
+
+        # the outer groups are contiguous runs of the inner groups because of the sort
+        outer = _segment_starts(codes[:-1,order[starts]])
+        notnan = ~np.isnan(frequency)
+        if len(outer):
+            total = np.add.reduceat(np.where(notnan,frequency,0.0),outer)
+            count = np.add.reduceat(notnan.astype('int64'),outer)
+        else:
+            total, count = np.array([]), np.array([],dtype='int64')
+        with np.errstate(divide='ignore',invalid='ignore'):
+            mean = total/count
+
+        rows = order[starts[outer]]
+        index = _group_index(self,gcols[:-1],rows)
+        freqdf = EventTable({'frequency':mean},index=index)
+
+        if qcols is not None:
+            if list(qcols) == list(gcols[:len(qcols)]):
+                breaks = _segment_starts(codes[:len(qcols),order[starts[outer]]]) if len(qcols) else np.array([0])
+                freqdf['Q'] = _qfactor(mean,breaks)
+            else:
+                freqdf.getQFactor('frequency',gcols=qcols)
         
-        return EventTable(freqdf)
+        return freqdf
     
-    def getMovingAvg(self,col,n):
-        '''Adds a moving average column to the table for a desired window and column'''
-        self['MA_{}'.format(str(col))] = self[col].rolling(window=n).mean()
+    @instrumented('edo_moving_avg',rows=_table_rows)
+    def getMovingAvg(self,col,n,gcols=[],on=None,spans=[]):
+        '''
+        Adds moving average columns to the table for the desired windows and column
+        n : window or list of windows. ints are row counts, strings like "7D" are time windows over the on column
+        gcols : optional group columns so averages never cross from one group into another
+        on : time column (or index level) for time windows. rows are ordered by it within each group
+        spans : optional list of spans for exponentially weighted moving averages
+        A single window without spans keeps the MA_<col> name, otherwise columns are named MA<n>_<col> and EWMA<span>_<col>
+        All windows are computed from one sort of the table
+        '''
+        windows = n if isinstance(n,(list,tuple)) else [n]
+        single = not isinstance(n,(list,tuple)) and len(spans) == 0
+        if single and len(gcols) == 0 and on is None and not isinstance(n,str):
+            # one row window over the table order needs no sort, pandas rolling is fastest
+            self['MA_{}'.format(str(col))] = self[col].rolling(window=n).mean()
+            return None
+
+        values = self[col].to_numpy(dtype='float64')
+        codes, valid = _group_codes(self,gcols) if len(gcols) else (np.empty((0,len(self)),dtype='int64'),np.ones(len(self),dtype=bool))
+        tcodes = None
+        if on is not None:
+            # codes of the sorted distinct times keep the packed sort key small
+            tcodes, tvalues = pd.factorize(pd.to_datetime(_key_values(self,on)).to_numpy().astype('int64'),sort=True)
+            codes = np.vstack([codes,tcodes[None,:]])
+        if len(gcols) and on is None:
+            order, starts = _sorted_groups(codes,valid)
+        else:
+            order = _sorted_groups(codes,valid)[0] if len(codes) else np.arange(len(self))
+            starts = _segment_starts(codes[:len(gcols),order]) if len(gcols) else np.array([0])
+
+        svalues = values[order]
+        notnan = ~np.isnan(svalues)
+        # running sums of the non missing values and their counts. window sums are differences of these
+        csum = np.r_[0.0,np.cumsum(np.where(notnan,svalues,0.0))]
+        ccount = np.r_[0,np.cumsum(notnan)]
+        group_start = np.repeat(starts,np.diff(np.r_[starts,len(order)])) if len(order) else np.array([],dtype='int64')
+        positions = np.arange(len(order))
+
+        results = {}
+        for w in windows:
+            if isinstance(w,str):
+                if tcodes is None:
+                    raise ValueError(f'Time window {w} needs an on column')
+                left = _time_left(tcodes[order],tvalues,group_start,pd.Timedelta(w).value)
+                min_periods = 1
+            else:
+                left = np.maximum(positions - w + 1,group_start)
+                min_periods = w
+            count = ccount[positions+1] - ccount[left]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                mean = (csum[positions+1] - csum[left])/count
+            results['MA_{}'.format(str(col)) if single else 'MA{}_{}'.format(w,col)] = np.where(count >= min_periods,mean,np.nan)
+
+        for span in spans:
+            results['EWMA{}_{}'.format(span,col)] = _ewma(svalues,starts,span)
+
+        for name,sresult in results.items():
+            full = np.full(len(self),np.nan)
+            full[order] = sresult
+            self[name] = full
         return None
     
+    @instrumented('edo_qfactor',rows=_table_rows)
     def getQFactor(self,col,gcols=[]):
         '''Adds a Q factor column to the table'''
+        values = self[col].to_numpy(dtype='float64')
         
         if len(gcols) == 0:
-            self['Q'] = (np.abs(self[col]-self[col].shift())) / (self[col].shift()+self[col])
+            self['Q'] = _qfactor(values,np.array([0]))
         else:
-            gdf = self.groupby(gcols)
-            self['Q'] = (np.abs(gdf[col].shift(0)-gdf[col].shift())) / (gdf[col].shift()+gdf[col].shift(0))
+            # the previous value of every row within its group in one shift. finding it needs no sort of the table
+            prev = self.groupby(gcols,sort=False)[col].shift().to_numpy(dtype='float64')
+            with np.errstate(divide='ignore',invalid='ignore'):
+                self['Q'] = np.abs(values - prev)/(prev + values)
         return None
     
-    def shockNotice(self,sentcol='notice_sent'):
-        '''Adds a column for which notices have been sent or not'''
+    @instrumented('edo_update_shocks',rows=_table_rows)
+    def updateShocks(self,state,p,freqcol='frequency',qcol='Q'):
+        '''
+        Incremental version of getQFactor + getMovingAvg + detectShocks for only the newest rows
+        state is the ShockState left by the previous run and is updated in place
+        Rows within a group should be in time order. Runtime depends only on the new rows and the number of groups in them
+        '''
+        if freqcol not in self.columns:
+            raise AttributeError('No frequency column detected')
+
+        values = self[freqcol].to_numpy(dtype='float64')
+        window = state.window
+        keep = max(window-1,0)
+
+        # group the new rows with one sort. missing keys are a group of their own, like tuple keys in the state
+        codes = np.empty((len(state.gcols),len(self)),dtype='int64')
+        for i,c in enumerate(state.gcols):
+            codes[i] = pd.factorize(_key_values(self,c),use_na_sentinel=False)[0]
+        if len(state.gcols):
+            order, starts = _sorted_groups(codes,np.ones(len(self),dtype=bool))
+        else:
+            order, starts = np.arange(len(self)), np.array([0] if len(self) else [],dtype='int64')
+        counts = np.diff(np.r_[starts,len(order)])
+        firsts = order[starts]
+        keys = list(zip(*[[_pyvalue(x) for x in _key_values(self,c).iloc[firsts]] for c in state.gcols])) if len(state.gcols) else [()]*len(starts)
+
+        # stored state of every group as arrays
+        histories = [state.buffers.get(k,[]) for k in keys]
+        hlens = np.array([len(h) for h in histories],dtype='int64')
+        lasts = np.array([state.last.get(k,np.nan) for k in keys],dtype='float64')
+
+        # each group's buffer followed by its new rows, one block per group
+        blocks = np.r_[0,np.cumsum(hlens + counts)]
+        block_starts = blocks[:-1]
+        series = np.empty(blocks[-1])
+        hpos = np.repeat(block_starts - np.r_[0,np.cumsum(hlens)][:-1],hlens) + np.arange(hlens.sum())
+        series[hpos] = np.fromiter(itertools.chain.from_iterable(histories),dtype='float64',count=int(hlens.sum()))
+        rank = np.arange(len(order)) - np.repeat(starts,counts)
+        npos = np.repeat(block_starts + hlens,counts) + rank
+        series[npos] = values[order]
+
+        # previous value within the group, the stored last value for the first new row of each group
+        prev = np.full(len(values),np.nan)
+        sprev = np.empty(len(order))
+        sprev[1:] = values[order][:-1]
+        sprev[starts] = lasts
+        prev[order] = sprev
+
+        # moving average over windows of the block ending at every new row. windows with a missing value are missing
+        ma = np.full(len(values),np.nan)
+        if window > 0 and len(order):
+            notnan = ~np.isnan(series)
+            csum = np.r_[0.0,np.cumsum(np.where(notnan,series,0.0))]
+            cnan = np.r_[0,np.cumsum(~notnan)]
+            left = npos - window + 1
+            full = left >= np.repeat(block_starts,counts)
+            left = np.where(full,left,npos)
+            with np.errstate(invalid='ignore'):
+                means = np.where(full & (cnan[npos+1] == cnan[left]),(csum[npos+1] - csum[left])/window,np.nan)
+            ma[order] = means
+
+        # write the state back
+        ends = blocks[1:]
+        for g,k in enumerate(keys):
+            state.last[k] = float(series[ends[g]-1])
+            state.buffers[k] = series[max(block_starts[g],ends[g]-keep):ends[g]].tolist() if keep else []
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            self[qcol] = np.abs(values - prev)/(prev + values)
+        self['MA_{}'.format(str(freqcol))] = ma
+        self['shock_detected'] = self[qcol] >= p
+
+        return None
+
+    @instrumented('edo_shock_notice',rows=_table_rows)
+    def shockNotice(self,sentcol='notice_sent',notifier=None):
+        '''
+        Adds a column for which notices have been sent or not
+        Notices for all new shocks are handed to the notifier at once so they are sent as digests over one connection
+        notifier : optional Notifier to send with. it is flushed here, without one a Notifier is made and closed
+        Rows are only marked as sent once their notice went out. failed notices stay unsent and are tried again on the next call
+        '''
         if sentcol not in self.columns:
             self[sentcol] = False
             
-        noNoticeSent = (self['shock_detected']==True) & (self['notice_sent']==False)
+        noNoticeSent = (self['shock_detected']==True) & (self[sentcol]==False)
         
-        for ind in self[noNoticeSent].index:
-            message = 'Frequency degradation detected'
-            notice = FrequencyDegrade(message=message,degrade_params=ind,Q=self[noNoticeSent].loc[ind]['Q'])
-            notice.send_notice()
-            
-        self.loc[noNoticeSent==True,sentcol] = True
+        message = 'Frequency degradation detected'
+        flagged = self.loc[noNoticeSent,'Q']
+        notices = [FrequencyDegrade(message=message,degrade_params=ind,Q=q) for ind,q in zip(flagged.index,flagged.to_numpy())]
+        if len(notices) == 0:
+            return None
+
+        own = notifier is None
+        notifier = notifier or Notifier()
+        notifier.submit(notices)
+        failed = notifier.close() if own else notifier.flush()
+
+        delivered = np.array([n.key not in failed for n in notices])
+        self.iloc[np.flatnonzero(noNoticeSent.to_numpy())[delivered],self.columns.get_loc(sentcol)] = True
         
         return None
     
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''
+Notices for detected shocks and a notifier that batches, rate limits and dedupes them
+'''
+import os
+import json
+import time
+import queue
+import smtplib
+import threading
+from abc import ABC, abstractmethod
+from email.mime.text import MIMEText
+
+class Notice(ABC):
+    '''Base class for notices sent by EDO'''
+    def __init__(self,message,degrade_params):
+        self.message = message
+        self.degrade_params = degrade_params
+
+    @property
+    def key(self):
+        '''Identifies the notice across runs for deduplication'''
+        return json.dumps([str(x) for x in self._params()])
+
+    @property
+    def group(self):
+        '''Notices with the same group are sent together in one digest. defaults to the first degrade param (the event)'''
+        return str(self._params()[0])
+
+    def _params(self):
+        if isinstance(self.degrade_params,(tuple,list)):
+            return list(self.degrade_params)
+        return [self.degrade_params]
+
+    @abstractmethod
+    def body(self):
+        return None
+
+    def send_notice(self,notifier=None):
+        '''Sends this notice on its own. Use Notifier.submit to batch many notices'''
+        notifier = notifier or Notifier()
+        notifier.send_now([self])
+        return None
+
+class FrequencyDegrade(Notice):
+    '''Notice that the frequency of an event moved more than the shock threshold'''
+    def __init__(self,message,degrade_params,Q):
+        super(FrequencyDegrade,self).__init__(message,degrade_params)
+        self.Q = Q
+
+    def body(self):
+        return f'{self.message}: {self.degrade_params} Q={self.Q:.3f}'
+
+class Notifier():
+    '''
+    Sends notices as digest emails over one reused SMTP connection
+
+    host, port : SMTP server. a local debugging SMTP server is fine for testing
+    sender, recipients : email addresses
+    window : seconds notices are collected for before one digest per group is sent
+    max_per_minute : rate limit of sent messages
+    dedupe_path : optional json file of already sent notice keys so reruns don't send the same notice again
+    dedupe_ttl : seconds a sent notice is remembered for. defaults to one day
+    '''
+    def __init__(self,host='localhost',port=25,sender='edo@localhost',recipients=['edo@localhost'],
+            window=5.0,max_per_minute=30,dedupe_path=None,dedupe_ttl=86400):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.window = window
+        self.max_per_minute = max_per_minute
+        self.dedupe_path = dedupe_path
+        self.dedupe_ttl = dedupe_ttl
+        self.sent = self._load_sent()
+        self.connection = None
+        self.pending = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        self.send_times = []
+        self.failed = set()
+
+    def _load_sent(self):
+        if self.dedupe_path is None or not os.path.exists(self.dedupe_path):
+            return {}
+        with open(self.dedupe_path,'r') as f:
+            sent = json.load(f)
+        now = time.time()
+        return {k:t for k,t in sent.items() if now - t < self.dedupe_ttl}
+
+    def _save_sent(self):
+        if self.dedupe_path is None:
+            return None
+        with open(self.dedupe_path,'w') as f:
+            json.dump(self.sent,f)
+        return None
+
+    def _connect(self):
+        '''Reuses the open connection while the server still answers'''
+        if self.connection is not None:
+            try:
+                if self.connection.noop()[0] == 250:
+                    return self.connection
+            except smtplib.SMTPException:
+                pass
+        self.connection = smtplib.SMTP(self.host,self.port)
+        return self.connection
+
+    def _rate_limit(self):
+        '''Waits until another message fits in the last minute'''
+        now = time.monotonic()
+        self.send_times = [t for t in self.send_times if now - t < 60]
+        if len(self.send_times) >= self.max_per_minute:
+            time.sleep(60 - (now - self.send_times[0]))
+        self.send_times.append(time.monotonic())
+
+    def digest(self,notices):
+        '''Builds one message per group of notices'''
+        groups = {}
+        for n in notices:
+            groups.setdefault(n.group,[]).append(n)
+
+        messages = []
+        for group,grouped in groups.items():
+            msg = MIMEText('\n'.join(n.body() for n in grouped))
+            msg['Subject'] = f'EDO: {len(grouped)} shock(s) detected for {group}'
+            msg['From'] = self.sender
+            msg['To'] = ', '.join(self.recipients)
+            messages.append((msg,[n.key for n in grouped]))
+        return messages
+
+    def send_now(self,notices):
+        '''Dedupes and sends the notices as digests right away'''
+        with self.lock:
+            notices = [n for n in notices if n.key not in self.sent]
+            if len(notices) == 0:
+                return 0
+
+            sent = 0
+            for msg,keys in self.digest(notices):
+                self._rate_limit()
+                try:
+                    self._connect().sendmail(self.sender,self.recipients,msg.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    self.connection = None
+                    self._connect().sendmail(self.sender,self.recipients,msg.as_string())
+                now = time.time()
+                self.sent.update({k:now for k in keys})
+                sent += 1
+                # saved after every digest so a later failure or crash doesn't resend the ones already out
+                self._save_sent()
+            return sent
+
+    def submit(self,notices):
+        '''Queues notices to be sent in the background. Notices submitted within the window share digests'''
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._work,daemon=True)
+            self.worker.start()
+        for n in notices:
+            self.pending.put(n)
+        return None
+
+    def _work(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                try:
+                    batch.append(self.pending.get(timeout=max(deadline - time.monotonic(),0)))
+                except queue.Empty:
+                    break
+            try:
+                self.send_now(batch)
+            except (smtplib.SMTPException,OSError) as e:
+                # digests sent before the failure are already in sent, the rest are reported by flush
+                failed = {n.key for n in batch if n.key not in self.sent}
+                self.failed.update(failed)
+                print(f'Failed to send {len(failed)} notice(s): {e}')
+            for _ in batch:
+                self.pending.task_done()
+
+    def flush(self):
+        '''
+        Blocks until every submitted notice has been tried
+        Returns the set of keys of the notices that failed to send since the last flush
+        '''
+        self.pending.join()
+        failed, self.failed = self.failed, set()
+        return failed
+
+    def close(self):
+        '''Flushes and closes the connection. Returns the failed keys like flush'''
+        failed = self.flush()
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except smtplib.SMTPException:
+                pass
+            self.connection = None
+        return failed
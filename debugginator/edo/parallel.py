@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+'''
+Partitioned multi-process execution of EventTable pipelines
+Groups keyed by event are independent so each partition of events can be processed on its own core
+'''
+import os
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from debugginator.edo.edo import EventTable
+
+def frequency_shocks(table,gcols,mcols,p,qcols):
+    '''Default pipeline: getFrequency -> detectShocks. Notices are sent by the parent after the results are merged'''
+    freq = table.getFrequency(gcols,mcols,qcols=qcols)
+    freq.detectShocks(p,gcols=qcols)
+    return freq
+
+def _to_shared(df):
+    '''Writes the dataframe as an Arrow IPC stream directly into a shared memory block'''
+    import pyarrow as pa
+    # the index is always stored as a column so every partition keeps its original row labels
+    table = pa.Table.from_pandas(df,preserve_index=True)
+
+    # measure the stream first so it can be written straight into a block of the right size
+    mock = pa.MockOutputStream()
+    with pa.ipc.new_stream(mock,table.schema) as writer:
+        writer.write_table(table)
+    size = mock.size()
+
+    shm = shared_memory.SharedMemory(create=True,size=max(size,1))
+    sink = pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf))
+    with pa.ipc.new_stream(sink,table.schema) as writer:
+        writer.write_table(table)
+    # drop every view on the block so it can be closed later
+    del writer, sink, table
+    return shm, size
+
+def buckets(table,pcols,nparts):
+    '''
+    Partition number of every row of an Arrow table so every group of pcols lands in exactly one partition
+    Each column is dictionary encoded and only its distinct values are hashed, so this is cheap enough for every worker to repeat
+    '''
+    keys = np.zeros(table.num_rows,dtype='uint64')
+    for c in pcols:
+        encoded = table.column(c).combine_chunks().dictionary_encode()
+        hashes = pd.util.hash_array(encoded.dictionary.to_numpy(zero_copy_only=False))
+        # nulls get one extra code past the dictionary
+        codes = encoded.indices.fill_null(len(hashes)).to_numpy()
+        hashes = np.append(hashes,np.uint64(0))
+        keys = keys*np.uint64(0x100000001B3) ^ hashes[codes]
+    return keys % np.uint64(nparts)
+
+def _run_partition(name,size,pcols,nparts,part,pipeline,args,kwargs):
+    '''
+    Reads the shared table without it being pickled, keeps the rows of its own partition and runs the pipeline on them
+    Returns None for an empty partition
+    '''
+    import pyarrow as pa
+    shm = shared_memory.SharedMemory(name=name)
+    source = pa.py_buffer(shm.buf[:size])
+    shared = pa.ipc.open_stream(source).read_all()
+    rows = np.flatnonzero(buckets(shared,pcols,nparts) == part)
+    # take copies the partition out of the block, only those rows are converted to pandas
+    result = pipeline(EventTable(shared.take(rows).to_pandas()),*args,**kwargs) if len(rows) > 0 else None
+
+    # the pipeline result is new data. drop every view on the block before closing it
+    del shared, source
+    shm.close()
+    return result
+
+class ParallelExecutor():
+    '''
+    Runs an EventTable pipeline over hash partitions of the table in a process pool
+
+    pcols : columns to partition on. every group the pipeline works on must be contained in one partition (e.g. the event column)
+    processes : number of worker processes. defaults to the number of cores
+    nparts : number of partitions. defaults to the number of processes
+
+    The table is written to shared memory once as Arrow. every worker reads it without a copy and takes its own partition,
+    so the parent only does the one conversion before the workers start
+    Pipeline results are expected to be aggregates much smaller than the input and are returned normally
+    '''
+    def __init__(self,pcols,processes=None,nparts=None):
+        self.pcols = pcols
+        self.processes = processes or os.cpu_count()
+        self.nparts = nparts or self.processes
+
+    def run(self,table,pipeline=frequency_shocks,*args,**kwargs):
+        '''
+        Runs pipeline(partition,*args,**kwargs) on every partition and merges the results in group order
+        pipeline must be a module level function so the workers can import it and must return new data, not views of its input
+        '''
+        shm, size = _to_shared(table)
+        try:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                futures = [pool.submit(_run_partition,shm.name,size,self.pcols,self.nparts,part,pipeline,args,kwargs)
+                        for part in range(self.nparts)]
+                results = [r for r in (f.result() for f in futures) if r is not None]
+        finally:
+            shm.close()
+            shm.unlink()
+
+        if len(results) == 0:
+            return EventTable()
+        return EventTable(pd.concat(results).sort_index())
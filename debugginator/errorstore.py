@@ -0,0 +1,184 @@
+#-*- coding: utf-8 -*-
+'''
+Persisted reconstruction errors. Every row's error and per feature errors are written once as .npy columns
+with a sorted index, so re-thresholding, top-k queries and histograms don't rerun the autoencoder
+'''
+import os
+import json
+import numpy as np
+
+FORMAT_VERSION = 1
+METADATA = 'metadata.json'
+
+def _plain(values):
+    '''Ids as an array np.save writes without pickling. object ids, e.g. pandas string ids, become fixed width strings'''
+    values = np.asarray(values)
+    return values.astype(str) if values.dtype == object else values
+
+def _id_array(chunks):
+    '''
+    Row ids of every batch as one array that can be memory-mapped on load. ids keep their own dtype
+    MultiIndex ids become a structured array with one field per level
+    '''
+    nlevels = getattr(chunks[0],'nlevels',1)
+    if nlevels == 1:
+        return _plain(np.concatenate([np.asarray(c) for c in chunks]))
+    names = [str(n) if n is not None else f'level_{i}' for i,n in enumerate(chunks[0].names)]
+    levels = [_plain(np.concatenate([np.asarray(c.get_level_values(i)) for c in chunks])) for i in range(nlevels)]
+    ids = np.empty(len(levels[0]),dtype=[(n,l.dtype) for n,l in zip(names,levels)])
+    for n,l in zip(names,levels):
+        ids[n] = l
+    return ids
+
+class ErrorStoreWriter():
+    '''
+    Collects reconstruction errors batch by batch and writes the store with its sorted index on close
+
+    path : directory of the store. created if it doesn't exist
+    features : optional dict of Preprocesser feature -> [first column, last column + 1], e.g. ProcessedDataset.features
+               the per feature error is the mean absolute error over the feature's columns
+    '''
+    def __init__(self,path,features=None):
+        self.path = path
+        self.features = features
+        self.errors = []
+        self.feature_errors = []
+        self.row_ids = []
+        os.makedirs(self.path,exist_ok=True)
+
+        if self.features is not None:
+            self.names = list(self.features)
+            spans = np.array([self.features[n] for n in self.names])
+            # columns sorted by feature start so reduceat sums every feature's block
+            self.order = np.argsort(spans[:,0],kind='stable')
+            self.starts = spans[self.order,0]
+            self.widths = (spans[:,1] - spans[:,0])[self.order]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def append(self,processed,reconstructed,row_ids=None):
+        '''Adds the absolute errors of a batch. row_ids are optional ids of the rows of any dtype, e.g. the dataframe index'''
+        abs_error = np.abs(np.asarray(reconstructed,dtype='float32') - np.asarray(processed,dtype='float32'))
+        self.errors.append(abs_error.mean(axis=-1))
+        if self.features is not None:
+            per_feature = np.empty((len(abs_error),len(self.names)),dtype='float32')
+            per_feature[:,self.order] = np.add.reduceat(abs_error,self.starts,axis=1)/self.widths
+            self.feature_errors.append(per_feature)
+        if row_ids is not None:
+            self.row_ids.append(row_ids)
+        return None
+
+    def close(self):
+        errors = np.concatenate(self.errors) if self.errors else np.array([],dtype='float32')
+        order = np.argsort(errors,kind='stable')
+        np.save(os.path.join(self.path,'error.npy'),errors)
+        np.save(os.path.join(self.path,'order.npy'),order)
+        np.save(os.path.join(self.path,'sorted_error.npy'),errors[order])
+        if self.feature_errors:
+            np.save(os.path.join(self.path,'feature_error.npy'),np.concatenate(self.feature_errors))
+        if self.row_ids:
+            np.save(os.path.join(self.path,'row_id.npy'),_id_array(self.row_ids))
+
+        metadata = {'version':FORMAT_VERSION,
+                'rows':len(errors),
+                'features':self.names if self.features is not None else None,
+                'row_ids':len(self.row_ids) > 0
+                }
+        with open(os.path.join(self.path,METADATA),'w') as f:
+            json.dump(metadata,f,indent=4)
+        return None
+
+def build_error_store(autoencoder,batches,path,features=None,row_ids=None):
+    '''
+    Runs the autoencoder once over an iterable of processed batches and persists the errors
+
+    batches : iterable of processed matrices, e.g. ProcessedDataset.batches()
+    features : optional feature column map, e.g. ProcessedDataset.features
+    row_ids : optional ids of all rows in batch order
+    '''
+    offset = 0
+    with ErrorStoreWriter(path,features=features) as writer:
+        for batch in batches:
+            batch = np.asarray(batch,dtype='float32')
+            ids = None if row_ids is None else row_ids[offset:offset+len(batch)]
+            writer.append(batch,np.asarray(autoencoder(batch,training=False)),row_ids=ids)
+            offset += len(batch)
+    return ErrorStore(path)
+
+class ErrorStore():
+    '''
+    Read side of the store. Columns are memory-mapped and queries use the sorted index
+
+    Row positions are positions in the scored data. ids() maps them to the stored row ids
+    '''
+    def __init__(self,path):
+        self.path = path
+        with open(os.path.join(path,METADATA),'r') as f:
+            self.metadata = json.load(f)
+        if self.metadata['version'] != FORMAT_VERSION:
+            raise ValueError(f'Unsupported error store version {self.metadata["version"]}')
+        self.features = self.metadata['features']
+        self.error = np.load(os.path.join(path,'error.npy'),mmap_mode='r')
+        self.order = np.load(os.path.join(path,'order.npy'),mmap_mode='r')
+        self.sorted_error = np.load(os.path.join(path,'sorted_error.npy'),mmap_mode='r')
+        self.feature_error = np.load(os.path.join(path,'feature_error.npy'),mmap_mode='r') if self.features else None
+        self.row_id = np.load(os.path.join(path,'row_id.npy'),mmap_mode='r') if self.metadata['row_ids'] else None
+
+    def __len__(self):
+        return self.metadata['rows']
+
+    def count_above(self,threshold):
+        return len(self) - int(np.searchsorted(self.sorted_error,threshold,side='left'))
+
+    def flagged(self,threshold):
+        '''Positions and errors of every row with an error at or above the threshold, worst first'''
+        start = int(np.searchsorted(self.sorted_error,threshold,side='left'))
+        return np.asarray(self.order[start:][::-1]), np.asarray(self.sorted_error[start:][::-1])
+
+    def top_k(self,k):
+        '''Positions and errors of the k worst rows, worst first'''
+        k = min(k,len(self))
+        return np.asarray(self.order[len(self)-k:][::-1]), np.asarray(self.sorted_error[len(self)-k:][::-1])
+
+    def quantile(self,q):
+        '''Error at quantile q, e.g. the threshold that flags the top 1% is quantile(0.99)'''
+        if len(self) == 0:
+            return float('nan')
+        return float(self.sorted_error[min(int(np.floor(q*len(self))),len(self)-1)])
+
+    def histogram(self,bins=25,range=None):
+        '''Same counts and edges as np.histogram of all errors, counted from the sorted index'''
+        if range is None:
+            range = (float(self.sorted_error[0]),float(self.sorted_error[-1])) if len(self) else (0.0,1.0)
+        edges = np.linspace(range[0],range[1],bins + 1) if np.ndim(bins) == 0 else np.asarray(bins,dtype='float64')
+        # np.histogram bins are half open except the last one, which includes its right edge
+        cuts = np.searchsorted(self.sorted_error,edges,side='left')
+        cuts[-1] = np.searchsorted(self.sorted_error,edges[-1],side='right')
+        return np.diff(cuts), edges
+
+    def feature_errors(self,positions):
+        '''Per feature errors of the rows at the given positions as a dict of feature -> errors'''
+        if self.feature_error is None:
+            raise AttributeError('No per feature errors stored')
+        values = np.asarray(self.feature_error[np.asarray(positions)])
+        return {f:values[...,i] for i,f in enumerate(self.features)}
+
+    def worst_features(self,position,n=5):
+        '''The n features with the largest error in one row, as (feature, error) pairs'''
+        errors = self.feature_errors(position)
+        return sorted(((f,float(e)) for f,e in errors.items()),key=lambda fe: fe[1],reverse=True)[:n]
+
+    def ids(self,positions):
+        '''
+        Stored row ids of the given positions. the positions themselves when no ids were stored
+        MultiIndex ids come back as a structured array with one field per level
+        '''
+        if self.row_id is None:
+            return np.asarray(positions)
+        return np.asarray(self.row_id[np.asarray(positions)])
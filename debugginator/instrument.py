@@ -0,0 +1,218 @@
+#-*- coding: utf-8 -*-
+'''
+Stage level instrumentation. Emits timing spans, row counts, memory and throughput to pluggable sinks
+Disabled by default, in which case instrumented functions are called straight through
+
+Enable from code with debugginator.instrument.enable([JsonLinesSink('spans.jsonl')])
+or by setting DEBUGGINATOR_SPANS=<path to json lines file> before importing debugginator
+'''
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from types import GeneratorType
+
+_sinks = []
+_enabled = False
+_trace_memory = False
+# open spans of each thread, innermost last. tracemalloc keeps one peak so nested spans hand theirs to the outer span
+_open = threading.local()
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm','r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError,AttributeError):
+        return None
+
+def _count_rows(x):
+    '''Row count of a dataframe, array or tensor. None for anything else (e.g. generators of chunks)'''
+    shape = getattr(x,'shape',None)
+    if shape is not None and len(shape) > 0 and shape[0] is not None:
+        try:
+            return int(shape[0])
+        except TypeError:
+            return None
+    if isinstance(x,(list,tuple)) and len(x) > 0:
+        return _count_rows(x[0])
+    return None
+
+class JsonLinesSink():
+    '''Appends one json object per span to a file'''
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self,span):
+        with self.lock, open(self.path,'a') as f:
+            f.write(json.dumps(span) + '\n')
+
+    def flush(self):
+        return None
+
+class PrometheusTextSink():
+    '''
+    Aggregates spans per stage and writes them in the Prometheus text exposition format
+    Point a node_exporter textfile collector at the file to scrape it
+    '''
+    def __init__(self,path,prefix='debugginator'):
+        self.path = path
+        self.prefix = prefix
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def emit(self,span):
+        with self.lock:
+            t = self.totals.setdefault(span['stage'],{'calls':0,'seconds':0.0,'rows':0})
+            t['calls'] += 1
+            t['seconds'] += span['seconds']
+            t['rows'] += span['rows'] or 0
+        self.flush()
+
+    def flush(self):
+        lines = []
+        for metric,kind,help_text in [('calls','counter','Number of stage runs'),
+                ('seconds','counter','Total seconds spent in the stage'),
+                ('rows','counter','Total rows processed by the stage')]:
+            name = f'{self.prefix}_stage_{metric}_total'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for stage,t in sorted(self.totals.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {t[metric]}')
+        # write then rename so the collector never reads a half written file
+        with self.lock:
+            tmp = f'{self.path}.tmp'
+            with open(tmp,'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp,self.path)
+
+def enable(sinks,trace_memory=False):
+    '''
+    Turns instrumentation on
+    trace_memory : track bytes allocated by python/numpy with tracemalloc. accurate but slows everything down
+    '''
+    global _sinks, _enabled, _trace_memory
+    _sinks = list(sinks)
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+    return None
+
+def disable():
+    global _sinks, _enabled, _trace_memory
+    for sink in _sinks:
+        sink.flush()
+    _sinks = []
+    _enabled = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory = False
+    return None
+
+def is_enabled():
+    return _enabled
+
+class span():
+    '''
+    Context manager that times a stage and emits it to the sinks
+    Set .rows inside the block when the row count is only known there, or .discard to not emit the span
+    '''
+    def __init__(self,stage,rows=None,**labels):
+        self.stage = stage
+        self.rows = rows
+        self.labels = labels
+        self.discard = False
+
+    def __enter__(self):
+        if not _enabled:
+            return self
+        self.start_rss = _current_rss()
+        if _trace_memory:
+            stack = _open.__dict__.setdefault('spans',[])
+            current, peak = tracemalloc.get_traced_memory()
+            # keep the peak the outer span reached so far before resetting it for this one
+            if stack:
+                stack[-1].peak = max(stack[-1].peak,peak)
+            tracemalloc.reset_peak()
+            self.start_traced = current
+            self.peak = current
+            stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        if not _enabled:
+            return False
+        elapsed = time.perf_counter() - self.start
+        if _trace_memory:
+            stack = _open.__dict__.setdefault('spans',[])
+            self.peak = max(self.peak,tracemalloc.get_traced_memory()[1])
+            if stack and stack[-1] is self:
+                stack.pop()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak,self.peak)
+        if self.discard:
+            return False
+        end_rss = _current_rss()
+        record = {'stage':self.stage,
+                'start':time.time() - elapsed,
+                'seconds':elapsed,
+                'rows':self.rows,
+                'rows_per_sec':self.rows/elapsed if self.rows and elapsed > 0 else None,
+                'rss_delta_bytes':end_rss - self.start_rss if end_rss is not None and self.start_rss is not None else None,
+                'error':exc_type.__name__ if exc_type is not None else None
+                }
+        if _trace_memory:
+            record['bytes_allocated'] = self.peak - self.start_traced
+        record.update(self.labels)
+        for sink in _sinks:
+            sink.emit(record)
+        return False
+
+def _chunk_spans(stage,chunks):
+    '''Passes a generator of chunks through, emitting one span per chunk for the work of producing it'''
+    while True:
+        with span(stage) as s:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                s.discard = True
+                return
+            s.rows = _count_rows(chunk)
+        yield chunk
+
+def instrumented(stage,rows=None,chunks=False):
+    '''
+    Decorator that wraps a function in a span
+    rows : optional function (args,kwargs,result) -> row count. defaults to the rows of the result, or of the first argument
+    chunks : when the function returns a generator, e.g. chunked reads, emit one span per chunk as it is consumed
+             instead of one for the call, which would only time creating the generator
+    When instrumentation is disabled the function is called straight through
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not _enabled:
+                return func(*args,**kwargs)
+            with span(stage) as s:
+                result = func(*args,**kwargs)
+                if chunks and isinstance(result,GeneratorType):
+                    s.discard = True
+                    return _chunk_spans(stage,result)
+                if rows is not None:
+                    s.rows = rows(args,kwargs,result)
+                else:
+                    s.rows = _count_rows(result)
+                    if s.rows is None:
+                        # methods get self first, look at the first data argument instead
+                        data = [a for a in args[1:] if _count_rows(a) is not None]
+                        s.rows = _count_rows(data[0]) if data else None
+            return result
+        return wrapper
+    return decorator
+
+if os.environ.get('DEBUGGINATOR_SPANS'):
+    enable([JsonLinesSink(os.environ['DEBUGGINATOR_SPANS'])])
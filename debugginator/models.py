@@ -8,6 +8,7 @@ Created by: Andrew Younger
 import tensorflow as tf
 from tensorflow.keras import layers, losses, Sequential
 from tensorflow.keras.models import Model
+from debugginator.instrument import instrumented
 
 class Encoder(Sequential):
     '''Inherit from Sequential for easier configuration and functionality
@@ -74,6 +75,14 @@ class AutoEncoder(Model):
         self.encoder_nodes = list(layer['config']['units'] for layer in self.encoder.get_config()['layers'])
         self.decoder_nodes = list(layer['config']['units'] for layer in self.decoder.get_config()['layers'])
 
+    @instrumented('model_fit')
+    def fit(self,*args,**kwargs):
+        return super(AutoEncoder,self).fit(*args,**kwargs)
+
+    @instrumented('model_predict')
+    def predict(self,*args,**kwargs):
+        return super(AutoEncoder,self).predict(*args,**kwargs)
+
     def call(self,x):
         encoded = self.encoder(x)
         decoded = self.decoder(encoded)
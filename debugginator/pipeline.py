@@ -0,0 +1,69 @@
+#-*- coding: utf-8 -*-
+'''
+tf.data pipelines that stream raw data through a trained Preprocesser for model training
+'''
+import numpy as np
+import tensorflow as tf
+
+def _raw_batches(chunks,numerical_features,categorical_features,batch_size):
+    '''Re-slices raw dataframe chunks into batches of exactly batch_size rows (except the last one)'''
+    numerical_carry = np.empty((0,len(numerical_features)),dtype='float32')
+    categorical_carry = np.empty((0,len(categorical_features)),dtype=object)
+    for chunk in chunks():
+        numerical = np.concatenate([numerical_carry,chunk[numerical_features].to_numpy(dtype='float32')])
+        categorical = np.concatenate([categorical_carry,chunk[categorical_features].astype(str).to_numpy(dtype=object)])
+        full = len(numerical) - len(numerical) % batch_size
+        for start in range(0,full,batch_size):
+            yield numerical[start:start+batch_size], categorical[start:start+batch_size]
+        numerical_carry, categorical_carry = numerical[full:], categorical[full:]
+    if len(numerical_carry) > 0:
+        yield numerical_carry, categorical_carry
+
+def training_dataset(preprocesser,chunks,batch_size=128,shuffle_buffer=64,cache=None,num_parallel_calls=tf.data.AUTOTUNE,targets=True):
+    '''
+    Builds a tf.data dataset that preprocesses raw batches on the fly so the processed matrix is never held in memory
+
+    preprocesser : trained Preprocesser
+    chunks : function returning a fresh iterator of raw dataframe chunks, e.g. lambda: extractor.get_df(path,chunksize=100000)
+             it is called again every epoch
+    batch_size : rows per training batch
+    shuffle_buffer : number of processed batches to shuffle between. 0 or None to keep the file order
+    cache : optional file path to cache the processed batches on disk after the first epoch
+    num_parallel_calls : parallelism of the preprocessing map
+    targets : yield (x,x) pairs for autoencoder training instead of just x. defaults to True
+    '''
+    if preprocesser.model is None:
+        raise AttributeError('No trained model to preprocess with. Run Preprocesser.train() first')
+    if preprocesser.sparse:
+        raise ValueError('Training datasets need a dense preprocesser output')
+
+    numericals = preprocesser.numerical_features
+    categoricals = preprocesser.categorical_features
+    model = preprocesser.model
+
+    dataset = tf.data.Dataset.from_generator(
+            lambda: _raw_batches(chunks,numericals,categoricals,batch_size),
+            output_signature=(
+                tf.TensorSpec(shape=(None,len(numericals)),dtype=tf.float32),
+                tf.TensorSpec(shape=(None,len(categoricals)),dtype=tf.string)
+                )
+            )
+
+    def preprocess(numerical,categorical):
+        if preprocesser.fused:
+            inputs = [numerical,categorical]
+        else:
+            # the per column model takes one (batch,1) input per feature
+            inputs = [numerical[:,i:i+1] for i in range(len(numericals))] + [categorical[:,i:i+1] for i in range(len(categoricals))]
+        return model(inputs,training=False)
+
+    dataset = dataset.map(preprocess,num_parallel_calls=num_parallel_calls)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer)
+    if targets:
+        dataset = dataset.map(lambda x: (x,x))
+
+    # overlap preprocessing of the next batches with the gradient step on the current one
+    return dataset.prefetch(tf.data.AUTOTUNE)
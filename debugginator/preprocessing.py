@@ -0,0 +1,329 @@
+#-*- coding: utf-8 -*-
+'''
+Preprocessing of extracted data into model inputs. Imports tensorflow, so debugginator.data only loads it on first use
+'''
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack
+import tensorflow as tf
+from tensorflow.keras import layers, losses
+from tensorflow.keras.models import Model
+from debugginator.instrument import instrumented
+
+class FusedPreprocessing(layers.Layer):
+    '''
+    Single layer version of the Preprocesser model
+    All numerical features arrive as one float32 matrix and are normalized in one op
+    All categorical features arrive as one string matrix and are looked up through one combined vocabulary table
+
+    mean, variance : per numerical feature normalization stats
+    vocabularies : list of per categorical feature vocabularies, without the OOV token
+    num_bins : optional number of hash bins per categorical feature. hashes values instead of looking them up when given
+    sparse : optional argument to return a SparseTensor instead of a dense tensor. defaults to False
+    '''
+    SEPARATOR = '\x1f'
+    OOV_TOKEN = '[UNK]'
+
+    def __init__(self,mean,variance,vocabularies,num_bins=None,sparse=False,**kwargs):
+        super(FusedPreprocessing,self).__init__(**kwargs)
+        self.mean = [float(m) for m in mean]
+        self.variance = [float(v) for v in variance]
+        self.vocabularies = [list(v) for v in vocabularies]
+        self.num_bins = num_bins
+        self.sparse = sparse
+
+        self.normalizer = None
+        if len(self.mean) > 0:
+            self.normalizer = layers.Normalization(axis=-1,mean=self.mean,variance=self.variance)
+
+        self.lookup = None
+        self.hasher = None
+        ncat = len(self.vocabularies)
+        if ncat > 0 and self.num_bins is not None:
+            # each column hashes into its own block of num_bins outputs
+            self.hasher = layers.Hashing(num_bins=self.num_bins)
+            self.offsets = tf.constant([i*self.num_bins for i in range(ncat)],dtype=tf.int64)
+            self.multi_hot = layers.CategoryEncoding(num_tokens=ncat*self.num_bins,output_mode='multi_hot',sparse=self.sparse)
+        elif ncat > 0:
+            # every column gets its own OOV slot in front of its vocabulary, same as one StringLookup per column
+            combined = []
+            oov_indices = []
+            for i,vocab in enumerate(self.vocabularies):
+                oov_indices.append(len(combined) + 1)
+                combined += [f'{i}{self.SEPARATOR}{t}' for t in [self.OOV_TOKEN] + vocab]
+            self.prefixes = tf.constant([f'{i}{self.SEPARATOR}' for i in range(ncat)])
+            self.oov_indices = tf.constant(oov_indices,dtype=tf.int64)
+            self.lookup = layers.StringLookup(vocabulary=combined,num_oov_indices=1)
+            self.multi_hot = layers.CategoryEncoding(num_tokens=len(combined),output_mode='multi_hot',sparse=self.sparse)
+
+    def _encode(self,categorical):
+        if self.hasher is not None:
+            return self.multi_hot(self.hasher(categorical) + self.offsets)
+
+        keys = tf.strings.join([tf.broadcast_to(self.prefixes,tf.shape(categorical)),categorical])
+        ids = self.lookup(keys)
+        ids = tf.where(ids == 0,tf.broadcast_to(self.oov_indices,tf.shape(ids)),ids)
+        # shift past the shared OOV index. every value maps to its own column's slot
+        return self.multi_hot(ids - 1)
+
+    def call(self,inputs):
+        numerical, categorical = inputs
+        outputs = []
+        if self.normalizer is not None:
+            normalized = self.normalizer(numerical)
+            outputs.append(tf.sparse.from_dense(normalized) if self.sparse else normalized)
+        if self.lookup is not None or self.hasher is not None:
+            outputs.append(self._encode(categorical))
+        if self.sparse:
+            return tf.sparse.concat(axis=-1,sp_inputs=outputs)
+        return tf.concat(outputs,axis=-1)
+
+    def get_config(self):
+        return {**super(FusedPreprocessing,self).get_config(),**{
+            'mean':self.mean,
+            'variance':self.variance,
+            'vocabularies':self.vocabularies,
+            'num_bins':self.num_bins,
+            'sparse':self.sparse
+            }}
+
+class Preprocesser():
+    '''
+    Preprocesser class takes a pandas dataframe as input and additional arguments to specify the encoding needed for the column
+    Used like a general model except done on a specific dataframe not a general object
+
+    df : pandas dataframe input argument. can also be an iterator of dataframe chunks for data that doesn't fit in memory
+    categorical_features : optional arugment to specify which columns should be vectorized. defaults to empty list
+    numerical_features : optional argument to specify which columns should be normalized. defaults to empty list
+    fused : optional argument to build a single layer model that takes one numerical and one categorical matrix. defaults to False
+    encoding : how categorical features are encoded. 'one_hot' (default) looks values up in the fitted vocabulary, 'hash' hashes them into num_bins outputs per feature
+    num_bins : number of hash bins per categorical feature when encoding is 'hash'
+    min_count : optional minimum count for a token to be kept in a vocabulary. rarer tokens go to the OOV bucket. defaults to 1
+    max_tokens : optional cap on the vocabulary size of each feature, keeping the most frequent tokens. defaults to None
+    sparse : optional argument to output a scipy CSR matrix instead of a dense array. needs fused=True. defaults to False
+
+    predict method : takes an array of the correct size and perfroms the preprocessing
+    train method : uses the input df to train the preprocesser
+    fit method : collects the normalization stats and vocabularies in a single pass over the df or chunks
+    '''
+    def __init__(self,df,categorical_features=[],numerical_features=[],fused=False,encoding='one_hot',num_bins=None,min_count=1,max_tokens=None,sparse=False):
+        self.df = df
+        self.chunks = None
+        self.categorical_features = categorical_features
+        self.numerical_features = numerical_features
+        self.fused = fused
+        self.encoding = encoding
+        self.num_bins = num_bins
+        self.min_count = min_count
+        self.max_tokens = max_tokens
+        self.sparse = sparse
+        self.normalized_features = []
+        self.numerical_inputs = []
+        self.categorical_inputs = []
+        self.encoded_features = []
+        self.means = None
+        self.variances = None
+        self.vocabularies = None
+        self.token_counts = None
+        self.model = None
+
+        if self.encoding not in ['one_hot','hash']:
+            raise ValueError(f'Encoding {self.encoding} not currently supported')
+        if self.encoding == 'hash' and self.num_bins is None:
+            raise ValueError('num_bins is needed for hash encoding')
+        if self.sparse and not self.fused:
+            raise ValueError('Sparse output needs fused=True')
+
+        # use the first chunk to work out the feature types and put it back in front of the rest
+        sample = self.df
+        if not isinstance(self.df,pd.DataFrame):
+            chunks = iter(self.df)
+            sample = next(chunks)
+            self.chunks = itertools.chain([sample],chunks)
+            self.df = None
+        
+        if len(self.categorical_features) == 0:
+            self.categorical_features = [c for c in sample.columns if sample[c].dtype not in ['int64','float64']]
+        if len(self.numerical_features) == 0:
+            self.numerical_features = [c for c in sample.columns if sample[c].dtype in ['int64','float64']]
+
+    @instrumented('preprocess_fit',rows=lambda args,kwargs,result: args[0].rows)
+    def fit(self,data=None):
+        '''
+        Collects the mean and variance of every numerical feature and the vocabulary of every categorical feature
+        Done in a single pass over data which can be a dataframe or an iterator of dataframe chunks. defaults to the preprocesser df
+        '''
+        if data is None:
+            data = self.df if self.df is not None else self.chunks
+        if data is None:
+            raise ValueError('No data to fit. Chunked data can only be used once, pass a new iterator to fit()')
+        if data is self.chunks:
+            self.chunks = None
+        if isinstance(data,pd.DataFrame):
+            data = [data]
+
+        count = pd.Series(0.0,index=self.numerical_features)
+        mean = pd.Series(0.0,index=self.numerical_features)
+        m2 = pd.Series(0.0,index=self.numerical_features)
+        counts = {c:pd.Series(dtype='float64') for c in self.categorical_features}
+        rows = 0
+
+        for chunk in data:
+            rows += len(chunk)
+            if len(self.numerical_features) > 0:
+                # merge the moments of the chunk with the running moments (Chan et al. parallel variance)
+                values = chunk[self.numerical_features].astype('float64')
+                ccount = values.count()
+                cmean = values.mean().fillna(0.0)
+                cm2 = (values.var(ddof=0)*ccount).fillna(0.0)
+                total = count + ccount
+                delta = cmean - mean
+                mean = (mean + delta*ccount/total).fillna(0.0)
+                m2 = (m2 + cm2 + delta**2*count*ccount/total).fillna(0.0)
+                count = total
+            for c in self.categorical_features:
+                counts[c] = counts[c].add(chunk[c].astype(str).value_counts(),fill_value=0)
+
+        self.means = mean.to_dict()
+        self.variances = (m2/count).fillna(0.0).to_dict()
+        # most frequent tokens first, same ordering as the keras lookup layers use when adapting
+        self.token_counts = {c:sorted(counts[c].items(),key=lambda kv:(kv[1],kv[0]),reverse=True) for c in counts}
+        self.vocabularies = {c:self._prune(self.token_counts[c]) for c in counts}
+        self.rows = rows
+
+        print(f'Fit {len(self.numerical_features)+len(self.categorical_features)} features over {rows} rows')
+        return None
+
+    def _prune(self,token_counts):
+        '''Drops tokens rarer than min_count and keeps at most max_tokens. dropped tokens are encoded in the OOV bucket'''
+        vocab = [t for t,n in token_counts if n >= self.min_count]
+        if self.max_tokens is not None:
+            vocab = vocab[:self.max_tokens]
+        return vocab
+
+    def _check_fit(self):
+        if self.means is None or self.vocabularies is None:
+            self.fit()
+
+    def normalize(self):
+        '''
+        Normalizes the numerical features of the dataframe. Resets the normalization attributes to empty.
+        '''
+        self._check_fit()
+        self.normalized_features = []
+        self.numerical_inputs = []
+        for n in self.numerical_features:
+            ninput = layers.Input(shape=(1,),dtype=tf.float32)
+            normalizer = layers.Normalization(mean=self.means[n],variance=self.variances[n])
+            normalized_data = normalizer(ninput)
+            self.numerical_inputs.append(ninput)
+            self.normalized_features.append(normalized_data)
+
+        print(f'Normalized {len(self.numerical_features)} of {self._ncols()} total columns')
+
+    def encode(self):
+        '''
+        Encodes the categorical features of the dataframe. Resets the encoding attributes to empty
+        Supports one-hot encoding over the fitted vocabulary or hashing into num_bins outputs
+        '''
+        self._check_fit()
+        self.categorical_inputs = []
+        self.encoded_features = []
+        for c in self.categorical_features:
+            cinput = layers.Input(shape=(1,),dtype=tf.string)
+            if self.encoding == 'hash':
+                hashed = layers.Hashing(num_bins=self.num_bins)(cinput)
+                encoded = layers.CategoryEncoding(num_tokens=self.num_bins,output_mode='one_hot')(hashed)
+            else:
+                encoder = layers.StringLookup(vocabulary=self.vocabularies[c],output_mode='one_hot')
+                encoded = encoder(cinput)
+            self.categorical_inputs.append(cinput)
+            self.encoded_features.append(encoded)
+
+        print(f'Encoded {len(self.categorical_features)} of {self._ncols()} total columns')
+
+    def _ncols(self):
+        return len(self.numerical_features) + len(self.categorical_features)
+
+    @instrumented('preprocess_train',rows=lambda args,kwargs,result: args[0].rows)
+    def train(self):
+        '''
+        Train the preprocesser to accept inputs in the same form as its own df
+        Assigns a model to the preprocesser that can be used to predict things
+        '''
+        if self.fused:
+            self._check_fit()
+            self.model = self._fused_model()
+        else:
+            # check if the encoded features and/or normalized features exist and are not empty.
+            if len(self.encoded_features) == 0:
+                self.encode()
+            if len(self.normalized_features) == 0:
+                self.normalize()
+
+            output = layers.concatenate(self.normalized_features + self.encoded_features)
+            self.model = Model(inputs=self.numerical_inputs+self.categorical_inputs,outputs=[output])
+        print('Preprocess training finished')
+
+        if self.df is not None:
+            # one row is enough to get the encoded width, predicting the whole df here would double the cost of training
+            predicted = self.predict(self.df.iloc[:1])
+            print(f'Original dimensions: {self.df.shape}')
+            print(f'Encoded dimensions: {(len(self.df),predicted.shape[1])}')
+
+        return None
+
+    def _fused_model(self):
+        '''Builds the single layer model from the fitted stats and vocabularies'''
+        mean = [self.means[n] for n in self.numerical_features]
+        variance = [self.variances[n] for n in self.numerical_features]
+        vocabularies = [self.vocabularies[c] for c in self.categorical_features]
+
+        ninput = layers.Input(shape=(len(self.numerical_features),),dtype=tf.float32)
+        cinput = layers.Input(shape=(len(self.categorical_features),),dtype=tf.string)
+        num_bins = self.num_bins if self.encoding == 'hash' else None
+        output = FusedPreprocessing(mean,variance,vocabularies,num_bins=num_bins,sparse=self.sparse)([ninput,cinput])
+        return Model(inputs=[ninput,cinput],outputs=[output])
+
+    def _fused_inputs(self,x,numericals,categoricals):
+        numerical = x[numericals].to_numpy(dtype='float32')
+        categorical = x[categoricals].astype(str).to_numpy()
+        return [numerical,categorical]
+
+    @instrumented('preprocess_predict')
+    def predict(self,x,numerical_features=None,categorical_features=None,batch_size=4096):
+        '''
+        Preprocesses a dataframe. batch_size is the number of rows per model call,
+        small batches spend most of their time in per call overhead rather than in the preprocessing ops
+        '''
+        if self.model is None:
+            raise AttributeError('No trained model to make predictions. Run Preprocesser.train() first')
+
+        numericals = numerical_features or self.numerical_features
+        categoricals = categorical_features or self.categorical_features
+
+        if self.fused:
+            # the fused model is a couple of table lookups, so call it directly in batches instead of going through model.predict
+            numerical, categorical = self._fused_inputs(x,numericals,categoricals)
+            if len(numerical) == 0:
+                empty = np.empty((0,self.model.output_shape[-1]),dtype='float32')
+                return csr_matrix(empty) if self.sparse else empty
+            batches = [self.model([numerical[i:i+batch_size],categorical[i:i+batch_size]],training=False)
+                    for i in range(0,len(numerical),batch_size)]
+            if self.sparse:
+                return vstack([self._to_csr(b) for b in batches],format='csr')
+            return np.concatenate([np.asarray(b) for b in batches])
+
+        predict_list = [x[c] for c in numericals + categoricals]
+        return self.model.predict(predict_list,batch_size=batch_size)
+
+    def _to_csr(self,predicted):
+        indices = np.asarray(predicted.indices)
+        shape = tuple(np.asarray(predicted.dense_shape))
+        return csr_matrix((np.asarray(predicted.values),(indices[:,0],indices[:,1])),shape=shape)
+
+    def save(self,fname,fpath='/root/thedebugginator/models'):
+        if self.model is None:
+            raise AttributeError('No existing model to save.')
+        self.model.save(f'{fpath}/{fname}')
@@ -0,0 +1,152 @@
+#-*- coding: utf-8 -*-
+'''
+Quantized CPU inference. Trained autoencoders are converted to TFLite with post-training quantization
+calibrated on a sample of the training data, and scored through the TFLite interpreter
+'''
+import json
+import numpy as np
+import tensorflow as tf
+from debugginator.runtime import _dense_layers
+
+QUANTILES = [0.5,0.9,0.99,0.999]
+
+def export_tflite(autoencoder,fname,sample=None,mode='int8',calibration_rows=1000):
+    '''
+    Converts a trained autoencoder to a quantized TFLite model
+
+    autoencoder : trained autoencoder
+    fname : path of the .tflite file
+    sample : processed training rows to calibrate the int8 activation ranges on. needed for mode int8
+    mode : 'int8' quantizes weights and activations, 'float16' stores float16 weights, 'dynamic' quantizes weights only
+    calibration_rows : number of sample rows used for calibration
+    '''
+    width = int(_dense_layers(autoencoder)[0].kernel.shape[0])
+    call = tf.function(lambda x: autoencoder(x,training=False),
+            input_signature=[tf.TensorSpec(shape=(None,width),dtype=tf.float32)])
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([call.get_concrete_function()],autoencoder)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == 'int8':
+        if sample is None:
+            raise ValueError('int8 quantization needs a sample of processed training data to calibrate on')
+        sample = np.asarray(sample,dtype='float32')
+        rows = np.random.default_rng(7).choice(len(sample),size=min(calibration_rows,len(sample)),replace=False)
+        converter.representative_dataset = lambda: ([sample[i:i+1]] for i in rows)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode != 'dynamic':
+        raise ValueError(f'Quantization mode {mode} not currently supported')
+
+    with open(fname,'wb') as f:
+        f.write(converter.convert())
+    return None
+
+class QuantizedScorer():
+    '''
+    Scores with a quantized TFLite autoencoder. Same interface and outputs as Scorer
+
+    preprocesser : trained Preprocesser, or None to score already processed matrices with loss()
+    model_path : path of the .tflite file from export_tflite
+    threshold : reconstruction error above which a row is anomalous
+    num_threads : interpreter threads. defaults to the TFLite default
+    '''
+    def __init__(self,preprocesser,model_path,threshold,num_threads=None):
+        self.preprocesser = preprocesser
+        self.threshold = float(threshold)
+        self.interpreter = tf.lite.Interpreter(model_path=model_path,num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_rows = None
+
+    def reconstruct(self,processed):
+        processed = np.ascontiguousarray(processed,dtype='float32')
+        # the interpreter is only resized when the batch size changes
+        if self.batch_rows != len(processed):
+            self.interpreter.resize_tensor_input(self.input_index,list(processed.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_rows = len(processed)
+        self.interpreter.set_tensor(self.input_index,processed)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def loss(self,processed,batch_size=4096):
+        '''Mean absolute reconstruction error of every row of a processed matrix'''
+        losses = [np.mean(np.abs(self.reconstruct(processed[i:i+batch_size]) - processed[i:i+batch_size]),axis=-1)
+                for i in range(0,len(processed),batch_size)]
+        return np.concatenate(losses) if losses else np.array([],dtype='float32')
+
+    def score(self,x,batch_size=4096):
+        '''
+        Scores a dataframe batch by batch
+        Returns the positional indices of the anomalous rows and their reconstruction errors
+        '''
+        if self.preprocesser is None:
+            raise AttributeError('No preprocesser to score raw data with. Use loss() on processed data')
+        indices = []
+        scores = []
+        for start in range(0,len(x),batch_size):
+            loss = self.loss(np.asarray(self.preprocesser.predict(x.iloc[start:start+batch_size])),batch_size=batch_size)
+            ind = np.flatnonzero(loss >= self.threshold)
+            indices.append(ind + start)
+            scores.append(loss[ind])
+
+        if len(indices) == 0:
+            return np.array([],dtype='int64'), np.array([],dtype='float32')
+        return np.concatenate(indices), np.concatenate(scores)
+
+def _summary(loss):
+    return {'mean':float(np.mean(loss)),'std':float(np.std(loss)),'max':float(np.max(loss)),
+            **{f'q{q}':float(np.quantile(loss,q)) for q in QUANTILES}}
+
+def _precision_recall(predicted,actual):
+    true_positives = int(np.sum(predicted & actual))
+    precision = true_positives/int(np.sum(predicted)) if np.any(predicted) else float('nan')
+    recall = true_positives/int(np.sum(actual)) if np.any(actual) else float('nan')
+    return {'precision':precision,'recall':recall}
+
+def parity_report(autoencoder,quantized,processed,threshold,anomalous=None,fname=None,batch_size=4096):
+    '''
+    Compares the quantized model against the float model on processed data
+
+    autoencoder : the float keras autoencoder
+    quantized : QuantizedScorer of the exported model
+    processed : processed rows to compare on, ideally held out data
+    threshold : the stored anomaly threshold
+    anomalous : optional boolean labels, True for known anomalies
+    fname : optional json file to save the report to
+
+    Reports both loss distributions, the per row loss differences, the Kolmogorov-Smirnov distance between them,
+    how well the quantized flags agree with the float flags, and precision/recall of both against the labels
+    '''
+    processed = np.asarray(processed,dtype='float32')
+    float_loss = np.concatenate([np.mean(np.abs(np.asarray(autoencoder(processed[i:i+batch_size],training=False)) - processed[i:i+batch_size]),axis=-1)
+            for i in range(0,len(processed),batch_size)])
+    quant_loss = quantized.loss(processed,batch_size=batch_size)
+
+    # largest gap between the two empirical cdfs
+    grid = np.sort(np.concatenate([float_loss,quant_loss]))
+    float_cdf = np.searchsorted(np.sort(float_loss),grid,side='right')/len(float_loss)
+    quant_cdf = np.searchsorted(np.sort(quant_loss),grid,side='right')/len(quant_loss)
+
+    float_flags = float_loss >= threshold
+    quant_flags = quant_loss >= threshold
+    report = {
+            'rows':len(processed),
+            'threshold':float(threshold),
+            'float_loss':_summary(float_loss),
+            'quantized_loss':_summary(quant_loss),
+            'abs_diff':_summary(np.abs(quant_loss - float_loss)),
+            'ks_statistic':float(np.max(np.abs(float_cdf - quant_cdf))),
+            'flag_agreement':float(np.mean(float_flags == quant_flags)),
+            'flags_vs_float':_precision_recall(quant_flags,float_flags)
+            }
+    if anomalous is not None:
+        anomalous = np.asarray(anomalous,dtype=bool)
+        report['float_vs_labels'] = _precision_recall(float_flags,anomalous)
+        report['quantized_vs_labels'] = _precision_recall(quant_flags,anomalous)
+
+    if fname is not None:
+        with open(fname,'w') as f:
+            json.dump(report,f,indent=4)
+    return report
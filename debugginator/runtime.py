@@ -0,0 +1,157 @@
+#-*- coding: utf-8 -*-
+'''
+TensorFlow free inference. A trained Preprocesser and AutoEncoder are exported to a single .npz file
+that NumpyScorer runs with plain NumPy, so short scoring jobs skip the TensorFlow import and SavedModel load
+
+Only NumPy is imported here. Exporting reads the weights off the trained objects without importing TensorFlow either
+'''
+import numpy as np
+
+FORMAT_VERSION = 1
+# keras.backend.epsilon(), the floor the Normalization layer puts under the standard deviation
+EPSILON = 1e-7
+
+ACTIVATIONS = {
+        'linear':lambda x: x,
+        'relu':lambda x: np.maximum(x,0,out=x),
+        'sigmoid':lambda x: 1/(1 + np.exp(-x)),
+        'tanh':np.tanh
+        }
+
+def _dense_layers(model):
+    '''Dense layers of a (possibly nested) keras model in call order'''
+    dense = []
+    for layer in model.layers:
+        if hasattr(layer,'layers'):
+            dense += _dense_layers(layer)
+        elif hasattr(layer,'kernel'):
+            dense.append(layer)
+    return dense
+
+def export_runtime(preprocesser,autoencoder,fname,threshold=None):
+    '''
+    Writes everything NumpyScorer needs to one uncompressed .npz file
+
+    preprocesser : fitted Preprocesser with one_hot encoding
+    autoencoder : trained autoencoder made of Dense layers
+    fname : path of the .npz file
+    threshold : optional anomaly threshold stored with the model
+    '''
+    if preprocesser.means is None or preprocesser.vocabularies is None:
+        raise AttributeError('Preprocesser has not been fit. Run Preprocesser.fit() or train() first')
+    if preprocesser.encoding != 'one_hot':
+        raise ValueError(f'Encoding {preprocesser.encoding} is not supported by the NumPy runtime')
+
+    arrays = {
+            'format_version':np.array(FORMAT_VERSION),
+            'threshold':np.array(np.nan if threshold is None else threshold,dtype='float64'),
+            'numerical_features':np.array(preprocesser.numerical_features,dtype=str),
+            'categorical_features':np.array(preprocesser.categorical_features,dtype=str),
+            'mean':np.array([preprocesser.means[n] for n in preprocesser.numerical_features],dtype='float32'),
+            'variance':np.array([preprocesser.variances[n] for n in preprocesser.numerical_features],dtype='float32')
+            }
+    for i,c in enumerate(preprocesser.categorical_features):
+        arrays[f'vocabulary_{i}'] = np.array(preprocesser.vocabularies[c],dtype=str)
+
+    activations = []
+    for i,layer in enumerate(_dense_layers(autoencoder)):
+        arrays[f'kernel_{i}'] = np.asarray(layer.kernel,dtype='float32')
+        arrays[f'bias_{i}'] = np.asarray(layer.bias,dtype='float32') if layer.use_bias else np.zeros(layer.units,dtype='float32')
+        activations.append(layer.activation.__name__)
+    unsupported = [a for a in activations if a not in ACTIVATIONS]
+    if unsupported:
+        raise ValueError(f'Activations {unsupported} are not supported by the NumPy runtime')
+    arrays['activations'] = np.array(activations,dtype=str)
+
+    np.savez(fname,**arrays)
+    return None
+
+class NumpyScorer():
+    '''
+    NumPy version of Scorer loaded from an export_runtime file
+    Gives the same preprocessing, reconstruction and loss as the keras models within float32 tolerance
+
+    fname : path of the .npz file
+    threshold : optional threshold overriding the one stored in the file
+    '''
+    def __init__(self,fname,threshold=None):
+        with np.load(fname,allow_pickle=False) as f:
+            if int(f['format_version']) != FORMAT_VERSION:
+                raise ValueError(f'Unsupported runtime format version {int(f["format_version"])}')
+            self.numerical_features = f['numerical_features'].tolist()
+            self.categorical_features = f['categorical_features'].tolist()
+            self.mean = f['mean']
+            self.scale = np.maximum(np.sqrt(f['variance']),np.float32(EPSILON))
+            self.vocabularies = [f[f'vocabulary_{i}'] for i in range(len(self.categorical_features))]
+            self.activations = f['activations'].tolist()
+            self.kernels = [f[f'kernel_{i}'] for i in range(len(self.activations))]
+            self.biases = [f[f'bias_{i}'] for i in range(len(self.activations))]
+            self.threshold = float(f['threshold']) if threshold is None else float(threshold)
+
+        # sorted vocabularies for searchsorted lookups, mapped back to each token's output position
+        self.sorted_vocabularies = []
+        self.positions = []
+        for vocab in self.vocabularies:
+            order = np.argsort(vocab,kind='stable')
+            self.sorted_vocabularies.append(vocab[order])
+            self.positions.append(order)
+        # every categorical feature gets an OOV slot in front of its vocabulary, like StringLookup one_hot
+        sizes = [len(v) + 1 for v in self.vocabularies]
+        self.offsets = len(self.numerical_features) + np.concatenate([[0],np.cumsum(sizes)[:-1]]).astype('int64')
+        self.width = len(self.numerical_features) + sum(sizes)
+
+    def _lookup(self,values,i):
+        '''Output column of every value within feature i. 0 is the OOV slot'''
+        vocab = self.sorted_vocabularies[i]
+        if len(vocab) == 0:
+            return np.zeros(len(values),dtype='int64')
+        found = np.searchsorted(vocab,values)
+        found[found == len(vocab)] = 0
+        known = vocab[found] == values
+        return np.where(known,self.positions[i][found] + 1,0)
+
+    def preprocess(self,x):
+        '''
+        Normalizes and one hot encodes a dataframe (or dict of columns) into the autoencoder input matrix
+        '''
+        rows = len(x[self.numerical_features[0]] if self.numerical_features else x[self.categorical_features[0]])
+        processed = np.zeros((rows,self.width),dtype='float32')
+        if self.numerical_features:
+            numerical = np.column_stack([np.asarray(x[n],dtype='float32') for n in self.numerical_features])
+            processed[:,:len(self.numerical_features)] = (numerical - self.mean)/self.scale
+        for i,c in enumerate(self.categorical_features):
+            values = np.asarray(x[c]).astype(str)
+            processed[np.arange(rows),self.offsets[i] + self._lookup(values,i)] = 1.0
+        return processed
+
+    def reconstruct(self,processed):
+        output = processed
+        for kernel,bias,activation in zip(self.kernels,self.biases,self.activations):
+            output = ACTIVATIONS[activation](output @ kernel + bias)
+        return output
+
+    def loss(self,processed):
+        '''Mean absolute reconstruction error of every row'''
+        return np.mean(np.abs(self.reconstruct(processed) - processed),axis=-1)
+
+    def score(self,x,batch_size=4096):
+        '''
+        Scores a dataframe batch by batch
+        Returns the positional indices of the anomalous rows and their reconstruction errors, like Scorer.score
+        '''
+        if np.isnan(self.threshold):
+            raise ValueError('No threshold stored with the model. Pass one to NumpyScorer')
+        columns = {c:np.asarray(x[c]) for c in self.numerical_features + self.categorical_features}
+        rows = len(next(iter(columns.values())))
+        indices = []
+        scores = []
+        for start in range(0,rows,batch_size):
+            batch = {c:v[start:start+batch_size] for c,v in columns.items()}
+            loss = self.loss(self.preprocess(batch))
+            ind = np.flatnonzero(loss >= self.threshold)
+            indices.append(ind + start)
+            scores.append(loss[ind])
+
+        if len(indices) == 0:
+            return np.array([],dtype='int64'), np.array([],dtype='float32')
+        return np.concatenate(indices), np.concatenate(scores)
@@ -0,0 +1,93 @@
+#-*- coding: utf-8 -*-
+'''
+Scoring of new data with a trained preprocesser and autoencoder
+'''
+import json
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+from debugginator.preprocessing import Preprocesser, FusedPreprocessing
+from debugginator.instrument import instrumented
+
+def load_threshold(stats_path):
+    '''Reads the anomaly threshold saved in a model_stats.json file'''
+    with open(stats_path,'r') as f:
+        contents = json.loads(f.read())
+    return float(contents['Threshold'])
+
+class Scorer():
+    '''
+    Runs preprocess -> reconstruct -> threshold as one compiled graph per batch
+    Only the anomalous rows and their reconstruction errors are returned so no full size intermediate arrays are kept
+
+    preprocesser : trained Preprocesser or a saved preprocesser keras model
+    autoencoder : trained autoencoder model
+    threshold : reconstruction error above which a row is anomalous
+    numerical_features, categorical_features : feature order the preprocesser model expects. taken from the Preprocesser when one is given
+    fused : whether the preprocesser model takes the fused inputs. taken from the Preprocesser when one is given
+    '''
+    def __init__(self,preprocesser,autoencoder,threshold,numerical_features=[],categorical_features=[],fused=False):
+        if isinstance(preprocesser,Preprocesser):
+            if preprocesser.sparse:
+                raise ValueError('Scoring needs a dense preprocesser output')
+            numerical_features = numerical_features or preprocesser.numerical_features
+            categorical_features = categorical_features or preprocesser.categorical_features
+            fused = preprocesser.fused
+            preprocesser = preprocesser.model
+        if preprocesser is None:
+            raise AttributeError('No trained preprocesser model. Run Preprocesser.train() first')
+        # saved preprocesser models carry the sparse output in their output spec
+        if any(isinstance(getattr(o,'type_spec',None),tf.SparseTensorSpec) for o in preprocesser.outputs):
+            raise ValueError('Scoring needs a dense preprocesser output')
+
+        self.preprocesser = preprocesser
+        self.autoencoder = autoencoder
+        self.threshold = tf.constant(threshold,dtype=tf.float32)
+        self.numerical_features = numerical_features
+        self.categorical_features = categorical_features
+        self.fused = fused
+        self._score_batch = tf.function(self._graph,reduce_retracing=True)
+
+    @classmethod
+    def load(cls,preprocesser_path,autoencoder_path,numerical_features,categorical_features,stats_path=None,fused=False):
+        '''
+        Loads the saved preprocesser, autoencoder and threshold once
+        stats_path defaults to the model_stats.json saved with the autoencoder
+        '''
+        stats_path = stats_path or f'{autoencoder_path}/model_stats.json'
+        preprocesser = load_model(preprocesser_path,custom_objects={'FusedPreprocessing':FusedPreprocessing})
+        autoencoder = load_model(autoencoder_path)
+        return cls(preprocesser,autoencoder,load_threshold(stats_path),
+                numerical_features=numerical_features,categorical_features=categorical_features,fused=fused)
+
+    def _graph(self,inputs):
+        processed = self.preprocesser(inputs,training=False)
+        reconstructed = self.autoencoder(processed,training=False)
+        loss = tf.reduce_mean(tf.abs(reconstructed - processed),axis=-1)
+        indices = tf.where(loss >= self.threshold)[:,0]
+        return indices, tf.gather(loss,indices)
+
+    def _inputs(self,x):
+        if self.fused:
+            return [tf.constant(x[self.numerical_features].to_numpy(dtype='float32')),
+                    tf.constant(x[self.categorical_features].astype(str).to_numpy())]
+        numericals = [tf.constant(x[c].to_numpy(dtype='float32').reshape(-1,1)) for c in self.numerical_features]
+        categoricals = [tf.constant(x[c].astype(str).to_numpy().reshape(-1,1)) for c in self.categorical_features]
+        return numericals + categoricals
+
+    @instrumented('score',rows=lambda args,kwargs,result: len(args[1]))
+    def score(self,x,batch_size=4096):
+        '''
+        Scores a dataframe batch by batch
+        Returns the positional indices of the anomalous rows and their reconstruction errors
+        '''
+        indices = []
+        scores = []
+        for start in range(0,len(x),batch_size):
+            ind, loss = self._score_batch(self._inputs(x.iloc[start:start+batch_size]))
+            indices.append(ind.numpy() + start)
+            scores.append(loss.numpy())
+
+        if len(indices) == 0:
+            return np.array([],dtype='int64'), np.array([],dtype='float32')
+        return np.concatenate(indices), np.concatenate(scores)
@@ -0,0 +1,259 @@
+#-*- coding: utf-8 -*-
+'''
+Continuous ingestion of events and micro-batch scoring with a trained Scorer
+'''
+import io
+import os
+import csv
+import json
+import time
+import socket
+import threading
+import queue
+from collections import deque
+import numpy as np
+import pandas as pd
+
+class FileFollower():
+    '''
+    Follows a growing csv file like tail -f. The first line is taken as the header
+    Yields complete lines only, a partially written last line is held back until its newline arrives
+
+    poll_interval : seconds to wait before checking the file again when there is nothing new
+    from_start : start from the beginning of the file instead of only following new rows. defaults to True
+    '''
+    def __init__(self,path,poll_interval=0.1,from_start=True):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.from_start = from_start
+        self.header = None
+        self.stopped = threading.Event()
+
+    def __iter__(self):
+        while not os.path.exists(self.path) and not self.stopped.is_set():
+            time.sleep(self.poll_interval)
+
+        with open(self.path,'r') as f:
+            # the file can be created before its header is written, wait for the whole header line
+            header = ''
+            while not self.stopped.is_set():
+                header += f.readline()
+                if header.endswith('\n'):
+                    break
+                time.sleep(self.poll_interval)
+            else:
+                return
+            self.header = header.rstrip('\n')
+            if not self.from_start:
+                f.seek(0,os.SEEK_END)
+
+            partial = ''
+            while not self.stopped.is_set():
+                line = f.readline()
+                if not line:
+                    time.sleep(self.poll_interval)
+                    continue
+                partial += line
+                if not partial.endswith('\n'):
+                    continue
+                yield partial.rstrip('\n')
+                partial = ''
+
+    def stop(self):
+        self.stopped.set()
+
+class SocketSource():
+    '''
+    Listens on a local TCP socket for newline delimited csv rows
+    The first line sent on each connection is the header
+    '''
+    def __init__(self,host='127.0.0.1',port=7746):
+        self.host = host
+        self.port = port
+        self.header = None
+        self.stopped = threading.Event()
+
+    def __iter__(self):
+        with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            server.bind((self.host,self.port))
+            server.listen(1)
+            server.settimeout(0.5)
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                with conn, conn.makefile('r') as f:
+                    self.header = f.readline().rstrip('\n')
+                    for line in f:
+                        if self.stopped.is_set():
+                            break
+                        yield line.rstrip('\n')
+
+    def stop(self):
+        self.stopped.set()
+
+class JsonLinesSink():
+    '''Appends anomalies to a local json lines file. Stands in for the event bus'''
+    def __init__(self,path):
+        self.path = path
+
+    def write(self,df):
+        if len(df) == 0:
+            return None
+        records = df.to_json(orient='records',lines=True)
+        if not records.endswith('\n'):
+            records += '\n'
+        with open(self.path,'a') as f:
+            f.write(records)
+        return None
+
+class LatencyTracker():
+    '''Keeps the latest end-to-end latencies in a bounded window and reports percentiles'''
+    def __init__(self,window=10000):
+        self.samples = deque(maxlen=window)
+        self.rows = 0
+        self.batches = 0
+
+    def add(self,latencies):
+        self.samples.extend(latencies)
+        self.rows += len(latencies)
+        self.batches += 1
+
+    def percentile(self,q):
+        if len(self.samples) == 0:
+            return None
+        return float(np.percentile(self.samples,q))
+
+    def stats(self):
+        return {'rows':self.rows,
+                'batches':self.batches,
+                'p50':self.percentile(50),
+                'p99':self.percentile(99)
+                }
+
+class StreamScorer():
+    '''
+    Groups incoming rows into micro-batches by size or deadline and scores them as they arrive
+
+    scorer : Scorer used on each micro-batch
+    source : FileFollower, SocketSource or any iterable of csv lines with a header attribute
+    sink : object with a write(df) method that receives the anomalous rows of each batch
+    transform : optional function applied to each parsed batch before scoring (e.g. default extraction and type fixes)
+    batch_size : maximum rows per micro-batch
+    max_delay : maximum seconds the first row of a batch waits before the batch is scored
+    max_pending : size of the queue between the reader and the scorer. the reader blocks when it is full (backpressure)
+    '''
+    def __init__(self,scorer,source,sink,transform=None,batch_size=1024,max_delay=1.0,max_pending=10000):
+        self.scorer = scorer
+        self.source = source
+        self.sink = sink
+        self.transform = transform
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.latency = LatencyTracker()
+        self.stopped = threading.Event()
+        self.reader = None
+        self.failed_batches = 0
+        self.bad_rows = 0
+
+    def _put(self,item):
+        # put blocks while the queue is full so a slow scorer slows the reader down. it gives up once stopped
+        while not self.stopped.is_set():
+            try:
+                self.pending.put(item,timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self):
+        for line in self.source:
+            if self.stopped.is_set() or not self._put((time.monotonic(),line)):
+                break
+        self._put(None)
+
+    def _next_batch(self):
+        '''Collects rows until the batch is full or the oldest row has waited max_delay'''
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            # with no deadline yet, wake up now and then to notice stop()
+            timeout = 0.5 if deadline is None else max(deadline - time.monotonic(),0)
+            try:
+                item = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                if deadline is None and not self.stopped.is_set():
+                    continue
+                break
+            if item is None:
+                return batch, True
+            if deadline is None:
+                deadline = item[0] + self.max_delay
+            batch.append(item)
+        return batch, False
+
+    def _well_formed(self,line,width):
+        try:
+            return len(next(csv.reader([line],strict=True),[])) == width
+        except csv.Error:
+            return False
+
+    def _score(self,batch):
+        # rows that don't have exactly the header's fields are dropped before parsing so they can't change the batch's dtypes
+        width = len(next(csv.reader([self.source.header])))
+        good = [b for b in batch if self._well_formed(b[1],width)]
+        if len(good) < len(batch):
+            self.bad_rows += len(batch) - len(good)
+            print(f'Skipped {len(batch) - len(good)} malformed row(s)')
+        if len(good) == 0:
+            return None
+
+        arrivals = np.array([b[0] for b in good])
+        df = pd.read_csv(io.StringIO('\n'.join([self.source.header] + [b[1] for b in good])))
+        if self.transform is not None:
+            df = self.transform(df)
+
+        indices, scores = self.scorer.score(df,batch_size=self.batch_size)
+        self.sink.write(df.iloc[indices].assign(reconstruction_error=scores))
+        self.latency.add(time.monotonic() - arrivals)
+
+    def run(self,stats_every=None):
+        '''
+        Scores micro-batches until the source ends or stop() is called
+        stats_every : optional number of batches between printing the latency counters
+        '''
+        self.reader = threading.Thread(target=self._read,daemon=True)
+        self.reader.start()
+
+        done = False
+        try:
+            while not (done or self.stopped.is_set()):
+                batch, done = self._next_batch()
+                if len(batch) == 0:
+                    continue
+                # the last batch before the source ends is still scored
+                try:
+                    self._score(batch)
+                except Exception as e:
+                    # one unparseable or unscorable batch is dropped, the stream keeps going
+                    self.failed_batches += 1
+                    print(f'Skipped a batch of {len(batch)} rows: {type(e).__name__}: {e}')
+                    continue
+                if stats_every and self.latency.batches % stats_every == 0:
+                    print(json.dumps(self.stats()))
+        finally:
+            # unblocks the reader thread however the loop ends
+            self.stop()
+
+        return self.stats()
+
+    def stats(self):
+        return {**self.latency.stats(),'failed_batches':self.failed_batches,'bad_rows':self.bad_rows}
+
+    def stop(self):
+        self.stopped.set()
+        if hasattr(self.source,'stop'):
+            self.source.stop()
@@ -0,0 +1,135 @@
+#-*- coding: utf-8 -*-
+'''
+Architecture sweeps. The data is preprocessed once into .npy files that every worker memory-maps,
+then each Encoder/Decoder configuration and loss is trained in its own process with a fixed number of threads
+
+tensorflow is only imported in the worker processes
+'''
+import os
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from debugginator.dataset import ProcessedDataset
+
+LOSSES = {
+        'mae':lambda reconstructed,x: np.mean(np.abs(reconstructed - x),axis=-1),
+        'mse':lambda reconstructed,x: np.mean((reconstructed - x)**2,axis=-1)
+        }
+
+def write_matrix(matrix,fname):
+    '''Saves a processed matrix as float32 .npy so sweep workers can memory-map it instead of copying it'''
+    np.save(fname,np.asarray(matrix,dtype='float32'))
+    return fname
+
+def _open(path):
+    '''Memory-maps a .npy matrix or a sharded processed dataset directory'''
+    if os.path.isdir(path):
+        return ProcessedDataset(path)
+    return np.load(path,mmap_mode='r')
+
+def grid(layers,losses=['mae'],**options):
+    '''
+    Every combination of encoder layer lists and losses as sweep configurations
+    layers : list of encoder layer lists, e.g. [[32,16,4],[64,32,8]]. decoders mirror the encoder
+    options : any other config keys (epochs, batch_size, n_std) shared by every configuration
+    '''
+    return [{'layers':l,'loss':loss,**options} for l,loss in itertools.product(layers,losses)]
+
+def _init_worker(threads):
+    # limit the thread pools before tensorflow runs anything so workers don't fight over cores
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL','2')
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _batches(matrix,batch_size,seed):
+    '''Shuffled batches read straight from the memory-mapped matrix. batch order is shuffled, rows within a batch are not'''
+    starts = np.arange(0,len(matrix),batch_size)
+    np.random.default_rng(seed).shuffle(starts)
+    for start in starts:
+        batch = np.asarray(matrix[start:start+batch_size])
+        yield batch, batch
+
+def _losses(autoencoder,matrix,loss,batch_size=8192):
+    return np.concatenate([LOSSES[loss](np.asarray(autoencoder(np.asarray(matrix[i:i+batch_size]),training=False)),np.asarray(matrix[i:i+batch_size]))
+            for i in range(0,len(matrix),batch_size)])
+
+def _train(config,train_path,test_path,labels_path,seed):
+    '''Trains one configuration and scores it on the test data. Runs in a worker process'''
+    import tensorflow as tf
+    import debugginator.models
+    start = time.perf_counter()
+
+    name = config.get('name') or f'{config["loss"]}_{"-".join(str(l) for l in config["layers"])}'
+    epochs = config.get('epochs',20)
+    batch_size = config.get('batch_size',128)
+    n_std = config.get('n_std',1.0)
+    tf.keras.utils.set_random_seed(seed)
+
+    train = _open(train_path)
+    width = train.shape[1]
+    dataset = tf.data.Dataset.from_generator(
+            lambda: _batches(train,batch_size,seed),
+            output_signature=(tf.TensorSpec(shape=(None,width),dtype=tf.float32),tf.TensorSpec(shape=(None,width),dtype=tf.float32))
+            )
+
+    encoder = debugginator.models.Encoder(config['layers'])
+    decoder = debugginator.models.Decoder(config['decoder'] + [width] if 'decoder' in config else config['layers'][::-1][1:] + [width])
+    autoencoder = debugginator.models.AutoEncoder(encoder=encoder,decoder=decoder)
+    autoencoder.compile(optimizer=config.get('optimizer','adam'),loss=config['loss'])
+    fit_start = time.perf_counter()
+    history = autoencoder.fit(dataset,epochs=epochs,verbose=0)
+    fit_seconds = time.perf_counter() - fit_start
+
+    train_loss = _losses(autoencoder,train,config['loss'])
+    threshold = float(train_loss.mean() + n_std*train_loss.std())
+    result = {'name':name,'layers':str(config['layers']),'loss':config['loss'],'epochs':epochs,'batch_size':batch_size,
+            'final_loss':float(history.history['loss'][-1]),'threshold':threshold}
+
+    if test_path is not None:
+        test = _open(test_path)
+        flagged = _losses(autoencoder,test,config['loss']) >= threshold
+        result['flagged'] = int(flagged.sum())
+        if labels_path is not None:
+            anomalous = np.load(labels_path).astype(bool)
+            true_positives = int(np.sum(flagged & anomalous))
+            result['precision'] = true_positives/int(flagged.sum()) if flagged.any() else float('nan')
+            result['recall'] = true_positives/int(anomalous.sum()) if anomalous.any() else float('nan')
+            result['accuracy'] = float(np.mean(flagged == anomalous))
+
+    result['fit_seconds'] = fit_seconds
+    result['wall_seconds'] = time.perf_counter() - start
+    return result
+
+def run_sweep(configs,train_path,test_path=None,labels_path=None,processes=None,threads=1,seed=7,results_path=None):
+    '''
+    Trains every configuration in parallel worker processes and collects one results row per configuration
+
+    configs : list of dicts with 'layers' (encoder layer list) and 'loss' ('mae' or 'mse'). optional keys are
+              'name', 'decoder' (decoder layers without the output layer), 'epochs', 'batch_size', 'n_std' and 'optimizer'
+    train_path : .npy file of the processed training matrix from write_matrix, or a processed dataset directory
+    test_path : optional .npy file or processed dataset directory of the processed test matrix
+    labels_path : optional .npy file of boolean test labels, True for known anomalies
+    processes : number of worker processes. defaults to the number of cores divided by threads
+    threads : tensorflow threads per worker
+    seed : random seed of every worker so configurations are compared on the same batch order
+    results_path : optional csv file for the results table
+
+    Thresholds are mean + n_std standard deviations of the training loss. precision and recall are for flagging the labelled anomalies
+    '''
+    processes = processes or max(1,(os.cpu_count() or 1)//threads)
+    # spawn so workers start without a copy of any tensorflow state in the parent
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes,mp_context=context,initializer=_init_worker,initargs=(threads,)) as pool:
+        futures = [pool.submit(_train,config,train_path,test_path,labels_path,seed) for config in configs]
+        results = pd.DataFrame([f.result() for f in futures])
+
+    if results_path is not None:
+        results.to_csv(results_path,index=False)
+    return results
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Startup benchmark for the parts of debugginator that should not load tensorflow
+
+Every module is imported in a fresh interpreter a few times. The median import time is checked against its budget
+and the import must not pull in tensorflow. Exits with 1 when a budget is broken
+
+Usage:
+    python import_budget.py
+    python import_budget.py --budget 1.5 --runs 5 --output import_times.json
+'''
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# modules that must stay tensorflow free, with their import budget in seconds. pandas alone takes about half a second
+BUDGETS = {
+        'debugginator.data':1.0,
+        'debugginator.edo':0.2,
+        'debugginator.edo.edo':1.0,
+        'debugginator.edo.parallel':1.0,
+        'debugginator.runtime':0.5
+        }
+
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds':time.perf_counter() - start,'tensorflow':'tensorflow' in sys.modules}}))
+'''
+
+def time_import(module,runs):
+    '''Median import time of a module over fresh interpreters and whether it imported tensorflow'''
+    seconds = []
+    tensorflow = False
+    for _ in range(runs):
+        out = subprocess.run([sys.executable,'-c',PROBE.format(module=module)],capture_output=True,text=True,check=True)
+        probe = json.loads(out.stdout.strip().splitlines()[-1])
+        seconds.append(probe['seconds'])
+        tensorflow = tensorflow or probe['tensorflow']
+    return float(np.median(seconds)), tensorflow
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the tensorflow free debugginator modules')
+    parser.add_argument('--runs',type=int,default=3,help='fresh interpreters per module')
+    parser.add_argument('--budget',type=float,default=None,help='one budget in seconds for every module instead of the defaults')
+    parser.add_argument('--output',default=None,help='optional json file for the measured times')
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    for module,budget in BUDGETS.items():
+        budget = args.budget or budget
+        seconds, tensorflow = time_import(module,args.runs)
+        results[module] = {'seconds':seconds,'budget':budget,'tensorflow':tensorflow}
+        print(f'{module}: {seconds*1000:.0f}ms (budget {budget*1000:.0f}ms){" imports tensorflow" if tensorflow else ""}')
+        if seconds > budget or tensorflow:
+            failures.append(module)
+
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=4)
+        print(f'Saved import times to {args.output}')
+
+    if failures:
+        print(f'OVER BUDGET: {", ".join(failures)}')
+        sys.exit(1)
+    print('All imports within budget')
+
+if __name__ == '__main__':
+    main()
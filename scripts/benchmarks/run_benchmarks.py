@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+'''
+Performance benchmarks for the detection pipeline on synthetic data
+
+Measures rows/sec and peak RSS of extraction, preprocessing, autoencoder training and scoring latency per batch size
+Results are written as json and compared against a stored baseline. Regressions beyond the tolerance are flagged
+
+Usage:
+    python run_benchmarks.py --sizes 10k,1M --output results.json --baseline baseline.json
+    python run_benchmarks.py --sizes 10k --save-baseline baseline.json
+
+baseline.json next to this script holds the stored 10k baseline. Timings are machine specific so regenerate it
+with --save-baseline on the machine the comparisons run on
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import resource
+import numpy as np
+import pandas as pd
+import debugginator.data
+import debugginator.models
+import debugginator.scoring
+
+SIZES = {'10k':10_000,'1M':1_000_000,'10M':10_000_000}
+NUMERICAL = ['ai_positionx','ai_positiony','ai_positionz','playerpositionx','playerpositiony','playerpositionz','killdist']
+CATEGORICAL = ['weaponname','killtype','enemyarch','vehiclestate','gamemode']
+DROPPED = ['appid','sessionid','profileid','clientip','createddate']
+CONTEXTS = ['combat_contextid','combat_contextname','gamemode_contextid','gamemode_contextname']
+
+def generate(rows,fpath,seed=7):
+    '''Writes a raw-extract-like csv with dotted column names, context columns and default columns to drop'''
+    rng = np.random.default_rng(seed)
+    data = {}
+    for c in DROPPED:
+        data[f'fact_playerkill.{c}'] = rng.integers(0,1_000_000,rows)
+    for c in CONTEXTS:
+        data[f'fact_playerkill.{c}'] = rng.integers(0,50,rows)
+    for c in NUMERICAL:
+        data[f'fact_playerkill.{c}'] = rng.normal(0,300,rows).round(3)
+    for i,c in enumerate(CATEGORICAL):
+        data[f'fact_playerkill.{c}'] = rng.integers(0,5*(i+1)**2,rows).astype(str)
+    df = pd.DataFrame(data)
+    df.to_csv(fpath,index=False)
+    return None
+
+def write_droplist(fpath):
+    with open(fpath,'w') as f:
+        f.write('\n'.join(DROPPED) + '\n')
+
+def _current_rss():
+    '''Resident set size in bytes from /proc on linux, falls back to the lifetime peak elsewhere'''
+    try:
+        with open('/proc/self/status','r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+class Stage():
+    '''Times a stage and polls RSS in the background to get the peak memory above the starting point'''
+    def __init__(self,name,rows,results,interval=0.01):
+        self.name = name
+        self.rows = rows
+        self.results = results
+        self.interval = interval
+
+    def _poll(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak,_current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.done = threading.Event()
+        self.start_rss = _current_rss()
+        self.peak = self.start_rss
+        self.poller = threading.Thread(target=self._poll,daemon=True)
+        self.poller.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        elapsed = time.perf_counter() - self.start
+        self.done.set()
+        self.poller.join()
+        self.peak = max(self.peak,_current_rss())
+        self.results[self.name] = {
+                'rows':self.rows,
+                'seconds':elapsed,
+                'rows_per_sec':self.rows/elapsed if elapsed > 0 else None,
+                'peak_rss_mb':(self.peak - self.start_rss)/1024**2
+                }
+        print(f'{self.name}: {elapsed:.3f}s, {self.results[self.name]["rows_per_sec"]:.0f} rows/s, +{self.results[self.name]["peak_rss_mb"]:.1f}MB')
+        return False
+
+def run_size(label,rows,workdir,batch_sizes):
+    results = {}
+    raw_path = os.path.join(workdir,f'raw_{label}.csv')
+    droplist = os.path.join(workdir,'default_columns.txt')
+    write_droplist(droplist)
+    generate(rows,raw_path)
+
+    extractor = debugginator.data.Extractor()
+    with Stage('extract',rows,results):
+        df = extractor.get_df(raw_path)
+        df = extractor.default_extraction(df=df,datapath=droplist)
+    del df
+
+    with Stage('extract_projected',rows,results):
+        df = extractor.get_df(raw_path,extract_default=True,datapath=droplist)
+
+    preprocesser = debugginator.data.Preprocesser(df,numerical_features=NUMERICAL,categorical_features=CATEGORICAL,fused=True)
+    with Stage('preprocess_train',rows,results):
+        preprocesser.train()
+    with Stage('preprocess_predict',rows,results):
+        processed = preprocesser.predict(df)
+
+    encoder = debugginator.models.Encoder([32,16,4])
+    decoder = debugginator.models.Decoder([16,32,processed.shape[1]])
+    autoencoder = debugginator.models.AutoEncoder(encoder=encoder,decoder=decoder)
+    autoencoder.compile(optimizer='adam',loss='mae')
+    with Stage('autoencoder_fit_epoch',rows,results):
+        autoencoder.fit(processed,processed,epochs=1,batch_size=128,verbose=0)
+
+    scorer = debugginator.scoring.Scorer(preprocesser,autoencoder,threshold=0.1)
+    for batch_size in batch_sizes:
+        batch = df.iloc[:batch_size]
+        scorer.score(batch,batch_size=batch_size)
+        latencies = []
+        for _ in range(20):
+            start = time.perf_counter()
+            scorer.score(batch,batch_size=batch_size)
+            latencies.append(time.perf_counter() - start)
+        results[f'score_latency_{batch_size}'] = {
+                'rows':len(batch),
+                'p50_ms':float(np.percentile(latencies,50)*1000),
+                'p99_ms':float(np.percentile(latencies,99)*1000),
+                'rows_per_sec':len(batch)/float(np.median(latencies))
+                }
+        print(f'score batch {batch_size}: p50 {results[f"score_latency_{batch_size}"]["p50_ms"]:.2f}ms')
+
+    os.remove(raw_path)
+    return results
+
+def compare(results,baseline,tolerance):
+    '''Lists every metric that is worse than the baseline by more than the tolerance (fraction)'''
+    regressions = []
+    for size,stages in results.items():
+        for stage,metrics in stages.items():
+            base = baseline.get(size,{}).get(stage)
+            if base is None:
+                continue
+            # throughput should not drop, memory and latency should not grow
+            if base.get('rows_per_sec') and metrics.get('rows_per_sec') is not None and metrics['rows_per_sec'] < base['rows_per_sec']*(1 - tolerance):
+                regressions.append((size,stage,'rows_per_sec',base['rows_per_sec'],metrics['rows_per_sec']))
+            for key in ['peak_rss_mb','p50_ms','p99_ms']:
+                if key in base and key in metrics and base[key] > 0 and metrics[key] > base[key]*(1 + tolerance):
+                    regressions.append((size,stage,key,base[key],metrics[key]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the debugginator detection pipeline')
+    parser.add_argument('--sizes',default='10k',help='comma separated sizes from 10k,1M,10M')
+    parser.add_argument('--batch-sizes',default='1,64,1024,8192',help='comma separated scoring batch sizes')
+    parser.add_argument('--output',default='benchmark_results.json')
+    parser.add_argument('--baseline',default=None,help='baseline json to compare against')
+    parser.add_argument('--save-baseline',default=None,help='write the results as a new baseline')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='allowed fractional regression')
+    args = parser.parse_args()
+
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for label in args.sizes.split(','):
+            print(f'--- {label} rows ---')
+            results[label] = run_size(label,SIZES[label],workdir,batch_sizes)
+
+    with open(args.output,'w') as f:
+        json.dump(results,f,indent=4)
+    print(f'Saved results to {args.output}')
+
+    if args.save_baseline:
+        with open(args.save_baseline,'w') as f:
+            json.dump(results,f,indent=4)
+        print(f'Saved baseline to {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline,'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results,baseline,args.tolerance)
+        for size,stage,key,base,new in regressions:
+            print(f'REGRESSION {size} {stage} {key}: {base:.3f} -> {new:.3f}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline')
+
+if __name__ == '__main__':
+    main()
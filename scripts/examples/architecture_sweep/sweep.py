@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+'''
+Example script that sweeps the architectures and losses of the other example scripts in one run
+
+The data is extracted and preprocessed once, saved as memory-mapped matrices, and every configuration
+is trained in its own worker process
+'''
+
+import os
+import numpy as np
+import debugginator.data
+import debugginator.sweep
+from sklearn.model_selection import train_test_split
+
+data_path = '/root/thedebugginator/data/raw/drone_bullet_proper_10k.csv'
+bug_data  = '/root/thedebugginator/data/raw/drone_bullet_no_weapon_kills_1000.csv'
+sweep_path = '/root/thedebugginator/data/processed/sweep'
+
+if __name__ == '__main__':
+    extractor = debugginator.data.Extractor()
+
+    # both files are parsed at once. the source column says which file every row came from
+    df = extractor.get_df([data_path,bug_data])
+    df['label'] = (df.pop('source_file') == data_path).astype(int)
+    df = extractor.default_extraction(df=df)
+
+    numerical_features = [
+            'ai_positionx','ai_positiony','ai_positionz',
+            'playerpositionx','playerpositiony','playerpositionz','killdist'
+            ]
+
+    categorical_features = [c for c in df.columns if c not in numerical_features and c != 'label']
+
+    df.fillna(value={'combattakedown':0,'takedownstate':0},inplace=True)
+    df[categorical_features] = df[categorical_features].astype(str)
+
+    bad_columns = ['enemyarchdescription','combatweaponusedname','combattypeofkillname',
+                   'playerheatlevel','powerlevel','enemylvl','copfelony','crimfelony','factionid'
+            ]
+
+    df.drop(bad_columns,inplace=True,axis=1)
+
+    labels = df.pop('label')
+
+    train_data, test_data, train_labels, test_labels = train_test_split(df,labels,test_size=0.2,random_state=7)
+
+    # preprocess once. the workers only read the saved matrices
+    preprocesser = debugginator.data.Preprocesser(train_data)
+    preprocesser.train()
+
+    os.makedirs(sweep_path,exist_ok=True)
+    train_path = debugginator.sweep.write_matrix(preprocesser.predict(train_data),f'{sweep_path}/train.npy')
+    test_path = debugginator.sweep.write_matrix(preprocesser.predict(test_data),f'{sweep_path}/test.npy')
+    labels_path = f'{sweep_path}/test_labels.npy'
+    # label 0 is a bug
+    np.save(labels_path,(test_labels == 0).to_numpy())
+
+    configs = debugginator.sweep.grid(
+            [[32,16,4],[64,32,8],[32,8],[16,4]],
+            losses=['mae','mse'],
+            epochs=20,
+            batch_size=128
+            )
+
+    results = debugginator.sweep.run_sweep(configs,train_path,test_path=test_path,labels_path=labels_path,threads=2,
+            results_path='/root/thedebugginator/reports/architecture_sweep.csv')
+    print(results.sort_values('recall',ascending=False).to_string(index=False))
@@ -7,15 +7,10 @@ Author: Andrew Younger
 '''
 
 import pandas as pd
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from tensorflow.keras import losses
 import debugginator.data
-import json
+import debugginator.scoring
 
 extractor = debugginator.data.Extractor()
-preprocesser = load_model('/root/thedebugginator/models/example_preprocesser')
-autoencoder = load_model('/root/thedebugginator/models/example_autoencoder')
 
 test_df = extractor.get_df('/root/thedebugginator/data/raw/drone_bullet_no_weapon_kills_1000.csv')
 test_df = extractor.default_extraction(df=test_df)
@@ -36,19 +31,20 @@ bad_columns = [
         ]
 
 test_df.drop(bad_columns,inplace=True,axis=1)
-feature_list = [test_df[c] for c in numerical_features + categorical_features if c not in bad_columns]
+numerical_features = [c for c in numerical_features if c not in bad_columns]
+categorical_features = [c for c in categorical_features if c not in bad_columns]
 
-processed_data = preprocesser.predict(feature_list)
-reconstructions = autoencoder.predict(processed_data)
+# loads the preprocesser, autoencoder and threshold (from model_stats.json) once
+scorer = debugginator.scoring.Scorer.load(
+        '/root/thedebugginator/models/example_preprocesser',
+        '/root/thedebugginator/models/example_autoencoder',
+        numerical_features=numerical_features,
+        categorical_features=categorical_features
+        )
 
-ae_stats_path = '/root/thedebugginator/models/example_autoencoder/model_stats.json'
-with open(ae_stats_path,'r') as f:
-    contents = json.loads(f.read())
+bug_indices, bug_scores = scorer.score(test_df)
+# without tensorflow: debugginator.runtime.NumpyScorer('/root/thedebugginator/models/example_autoencoder/runtime.npz').score(test_df)
 
-threshold = float(contents['Threshold'])
-loss = losses.mae(reconstructions,processed_data)
-predictions = tf.math.less(loss,threshold).numpy()
-
-bug_events = test_df.iloc[predictions==False]
+bug_events = test_df.iloc[bug_indices].assign(reconstruction_error=bug_scores)
 print(bug_events)
 print('In an actual script you would save these bugged events!')
@@ -14,6 +14,11 @@ import tensorflow as tf
 from tensorflow.keras import layers, losses
 import debugginator.data
 import debugginator.models
+import debugginator.calibration
+import debugginator.runtime
+import debugginator.quantize
+import debugginator.dataset
+import debugginator.errorstore
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 from sklearn.model_selection import train_test_split
 import json
@@ -70,7 +75,7 @@ processed_train = preprocesser.predict(train_data)
 
 # save the preprocesser as an example of a preprocesser and the preprocessed data
 processed_path = '/root/thedebugginator/data/processed'
-extractor.save_df(df=pd.DataFrame(processed_train),savepath=f'{processed_path}/example_processed_data.csv')
+debugginator.dataset.write_processed(processed_train,f'{processed_path}/example_processed_data',preprocesser=preprocesser)
 
 preprocesser.save('example_preprocesser')
 
@@ -94,8 +99,13 @@ history = autoencoder.fit(
 autoencoder.save('/root/thedebugginator/models/example_autoencoder')
 print('Saved autoencoder model')
 
-reconstructions = autoencoder.predict(processed_train)
-train_loss = losses.mae(reconstructions,processed_train)
+# one pass over the training data stores every row's error, so the threshold, other thresholds, top-k events and
+# histograms all come from the store instead of running the model again
+error_store = debugginator.errorstore.build_error_store(autoencoder,
+        (processed_train[i:i+4096] for i in range(0,len(processed_train),4096)),
+        '/root/thedebugginator/models/example_autoencoder/train_errors',
+        features=debugginator.dataset.feature_columns(preprocesser)[1],
+        row_ids=train_data.index)
 
 def predict(model,data,threshold):
     reconstructions = model(data)
@@ -109,7 +119,10 @@ def print_stats(predictions,labels):
     f1_score = 2*precision*recall/(precision+recall)
     return accuracy, precision, recall, f1_score
 
-threshold = np.mean(train_loss) + np.std(train_loss)
+# the calibrator keeps the loss stats and quantile sketch saved with the model. the losses come from the error store
+calibrator = debugginator.calibration.ThresholdCalibrator()
+calibrator.update(error_store.error)
+threshold = calibrator.threshold(method='std',n_std=1)
 print(f'Testing using 1 STD threshold of: {threshold}')
 
 predictions = predict(autoencoder,processed_test,threshold)
@@ -131,6 +144,19 @@ stats_dict = {'Accuracy':str(a),
         }
 
 save_stats(stats_dict,'/root/thedebugginator/models/example_autoencoder/model_stats.json')
+calibrator.save('/root/thedebugginator/models/example_autoencoder/calibration.json')
+# numpy only copy of the preprocesser and autoencoder for scoring jobs that should not load tensorflow
+debugginator.runtime.export_runtime(preprocesser,autoencoder,'/root/thedebugginator/models/example_autoencoder/runtime.npz',threshold=threshold)
+
+# int8 model for cpu scoring, checked against the float model on the test data (label 0 is a bug)
+quantized_path = '/root/thedebugginator/models/example_autoencoder/autoencoder_int8.tflite'
+debugginator.quantize.export_tflite(autoencoder,quantized_path,sample=processed_train,mode='int8')
+quantized = debugginator.quantize.QuantizedScorer(preprocesser,quantized_path,threshold)
+parity = debugginator.quantize.parity_report(autoencoder,quantized,processed_test,threshold,anomalous=(test_labels==0).to_numpy(),
+        fname='/root/thedebugginator/models/example_autoencoder/quantization_parity.json')
+print(f'Quantized flag agreement: {parity["flag_agreement"]}')
+
+print(f'Rows above the threshold: {error_store.count_above(threshold)}')
 print('Saved model stats')
 
 # loss plot
@@ -147,7 +173,7 @@ print('Saved training-validation loss plot')
 
 # plot regular events' reconstruction
 plt.figsize=((10,15))
-regular_events = train_loss.numpy()[train_labels==1]
+regular_events = error_store.error[train_labels.to_numpy()==1]
 plt.hist(regular_events,bins=25)
 plt.title('Original POC Regular Reconstruction Error')
 plt.xlabel('Reconstruction Error')
@@ -159,7 +185,7 @@ print("Saved regular events' reconstruction plot")
 
 # plot bug events' reconstruction
 plt.figsize=((10,15))
-bug_events = train_loss.numpy()[train_labels==0]
+bug_events = error_store.error[train_labels.to_numpy()==0]
 plt.hist(bug_events,bins=25)
 plt.title('Original POC Anomaly Reconstruction Error')
 plt.xlabel('Reconstruction Error')
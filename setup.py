@@ -20,9 +20,12 @@ setup(
     version=info['__version__'],
     author='Andrew Younger',
     packages=['debugginator'] + ['debugginator.'+pkg for pkg in find_packages('debugginator')],
-    install_requires=['tensorflow>=2.7.0',
-                      'pandas>=1.3.4',
+    install_requires=['tensorflow>=2.9.0',
+                      'pandas>=1.5.0',
                       'numpy>=1.21.4',
-                      'scikit-learn>=1.0.1'
-                     ]
+                      'scipy>=1.7.3',
+                      'scikit-learn>=1.0.1',
+                      'pyarrow>=4.0.0'
+                     ],
+    extras_require={'spark':['pyspark>=3.2.0']}
 )
\ No newline at end of file
@@ -0,0 +1,112 @@
+#-*- coding: utf-8 -*-
+'''
+Checks the packed key grouping in edo against np.lexsort and pandas on every sort branch
+'''
+import numpy as np
+import pandas as pd
+import pytest
+from debugginator.edo.edo import EventTable, ShockState, _argsort_keys, _group_codes, _sorted_groups
+
+def _codes(rng,n,sizes):
+    '''Random code rows that reach both ends of each size so the packed key spans the full range'''
+    codes = np.stack([rng.integers(0,s,n) for s in sizes]).astype('int64')
+    codes[:,0] = 0
+    codes[:,1] = np.array(sizes) - 1
+    return codes
+
+def _reference(codes,valid):
+    order = np.lexsort(codes[::-1])
+    order = order[valid[order]]
+    scodes = codes[:,order]
+    change = (np.diff(scodes,axis=1) != 0).any(axis=0)
+    return order, np.flatnonzero(np.r_[True,change]) if len(order) else np.array([],dtype='int64')
+
+# one case per branch: 16 bit radix, two 16 bit digits, argsort and the lexsort overflow fallback
+BRANCHES = {
+    '16bit': [7,300],
+    '32bit': [70000],
+    'argsort': [70000,70000],
+    'lexsort': [2**16]*4,
+}
+
+@pytest.mark.parametrize('sizes',BRANCHES.values(),ids=BRANCHES.keys())
+def test_sorted_groups_matches_lexsort(sizes):
+    rng = np.random.default_rng(0)
+    codes = _codes(rng,5000,sizes)
+    valid = rng.random(codes.shape[1]) > 0.1
+    order, starts = _sorted_groups(codes,valid)
+    ref_order, ref_starts = _reference(codes,valid)
+    np.testing.assert_array_equal(order,ref_order)
+    np.testing.assert_array_equal(starts,ref_starts)
+
+@pytest.mark.parametrize('size',[2**10,2**20,2**40])
+def test_argsort_keys_is_stable(size):
+    rng = np.random.default_rng(1)
+    key = rng.integers(0,size,5000)
+    # repeated keys check stability
+    key[::3] = key[0]
+    np.testing.assert_array_equal(_argsort_keys(key,size),np.argsort(key,kind='stable'))
+
+def test_sorted_groups_empty():
+    order, starts = _sorted_groups(np.empty((2,0),dtype='int64'),np.empty(0,dtype=bool))
+    assert len(order) == 0 and len(starts) == 0
+
+def test_group_codes_drop_missing_keys_like_pandas():
+    rng = np.random.default_rng(2)
+    n = 2000
+    df = pd.DataFrame({'event':rng.choice(['a','b','c',None],n),
+                       'version':rng.choice([1.0,2.0,np.nan],n),
+                       'count':rng.random(n)})
+    codes, valid = _group_codes(df,['event','version'])
+    order, starts = _sorted_groups(codes,valid)
+    sizes = np.diff(np.r_[starts,len(order)])
+    expected = df.groupby(['event','version']).size()
+    np.testing.assert_array_equal(sizes,expected.to_numpy())
+    firsts = df.iloc[order[starts]]
+    assert list(zip(firsts['event'],firsts['version'])) == list(expected.index)
+    np.testing.assert_array_equal(np.sort(order),np.flatnonzero(df[['event','version']].notna().all(axis=1)))
+
+def _loop_shocks(days,gcols,window,p):
+    '''Row by row reference of updateShocks with the full history of every group'''
+    history = {}
+    results = []
+    for df in days:
+        q, ma = [], []
+        for _, row in df.iterrows():
+            key = tuple(row[c] for c in gcols)
+            seen = history.setdefault(key,[])
+            prev = seen[-1] if seen else np.nan
+            seen.append(row['frequency'])
+            q.append(abs(row['frequency'] - prev)/(prev + row['frequency']))
+            last = seen[-window:]
+            ma.append(np.mean(last) if window > 0 and len(last) == window else np.nan)
+        q = np.array(q)
+        results.append((q,np.array(ma),q >= p))
+    return results, history
+
+@pytest.mark.parametrize('gcols',[['event'],['event','platform'],[]])
+@pytest.mark.parametrize('window',[0,1,3])
+def test_update_shocks_matches_loop(gcols,window):
+    rng = np.random.default_rng(3)
+    days = []
+    for day in range(4):
+        n = 200
+        df = pd.DataFrame({'event':rng.integers(0,15 + day*3,n),
+                           'platform':rng.choice(['pc','ps','xb'],n),
+                           'frequency':rng.random(n)})
+        df.loc[rng.integers(0,n,5),'frequency'] = np.nan
+        days.append(df)
+    expected, history = _loop_shocks(days,gcols,window,0.5)
+
+    state = ShockState(gcols=gcols,window=window)
+    for df, (q,ma,shock) in zip(days,expected):
+        table = EventTable(df.copy())
+        table.updateShocks(state,0.5)
+        np.testing.assert_allclose(table['Q'].to_numpy(),q)
+        np.testing.assert_allclose(table['MA_frequency'].to_numpy(),ma)
+        np.testing.assert_array_equal(table['shock_detected'].to_numpy(),shock)
+
+    assert set(state.last) == set(history)
+    for key, seen in history.items():
+        np.testing.assert_allclose(state.last[key],seen[-1])
+        np.testing.assert_allclose(state.buffers[key],seen[-(window-1):] if window > 1 else [])